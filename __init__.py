@@ -1,3 +1,13 @@
-from .compression import compress_text, decompress_text
-from .frequency_analysis import get_frequent_words, get_frequent_ngrams
+from .compression import compress_text, decompress_text, compress_bytes, decompress_bytes, compile_dictionary, \
+    CompressionEngine
+from .dictionary_format import load_dictionary, save_dictionary, MappedDictionary
+from .frequency_analysis import get_frequent_words, get_frequent_ngrams, CorpusStatistics
 from .api_client import send_gpt_request
+
+
+def __getattr__(name):
+    # TfidfIndex needs SciPy, which takes most of the package's import time; it loads on first use
+    if name == "TfidfIndex":
+        from .tfidf_index import TfidfIndex
+        return TfidfIndex
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,184 @@
+import random
+import threading
+import time
+from collections import deque
+
+import instrumentation
+
+DEFAULT_TIMEOUT = 60.0  # seconds to wait for the server (per read while streaming)
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE = 0.5  # seconds; doubles on every retry
+BACKOFF_MAX = 20.0
+RETRY_STATUS_CODES = {408, 409, 429}  # plus every 5xx
+METRICS_SIZE = 500  # most recent requests kept for latency reporting
+
+base_url = None  # None uses the SDK default (or OPENAI_BASE_URL)
+timeout = DEFAULT_TIMEOUT
+connect_timeout = DEFAULT_CONNECT_TIMEOUT
+max_retries = DEFAULT_MAX_RETRIES
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def configure(url=None, request_timeout=DEFAULT_TIMEOUT, request_connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+              retries=DEFAULT_MAX_RETRIES):
+    global base_url, timeout, connect_timeout, max_retries
+    base_url = url
+    timeout = request_timeout
+    connect_timeout = request_connect_timeout
+    max_retries = retries
+    close_clients()
+
+
+def get_client(api_key):
+    # One client per API key, kept for the life of the process so its connection pool
+    # (and the TLS sessions in it) is reused by every request. Retries are done here,
+    # so the SDK's own are turned off. The SDK is imported here, not at startup.
+    from openai import OpenAI, Timeout
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                            timeout=Timeout(timeout, connect=connect_timeout))
+            _clients[api_key] = client
+        return client
+
+
+def close_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def is_retryable(error):
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRY_STATUS_CODES or error.status_code >= 500
+    return isinstance(error, APIConnectionError)  # includes timeouts
+
+
+def backoff_delay(attempt, error=None):
+    # Full jitter: a random delay up to the exponential bound, so clients that failed
+    # together don't retry together. A Retry-After from the server is honoured.
+    from openai import APIStatusError
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class LatencyMetrics:
+    def __init__(self, size=METRICS_SIZE):
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, model, attempts, latency, first_token=None, total=None, error=None):
+        # latency: until the response headers arrived (all attempts included)
+        # first_token / total: until the first / last streamed chunk
+        with self.lock:
+            self.records.append({"model": model, "attempts": attempts, "latency": latency,
+                                 "first_token": first_token, "total": total, "error": error,
+                                 "time": time.time()})
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+    def summary(self):
+        records = self.snapshot()
+        summary = {"requests": len(records),
+                   "errors": sum(1 for record in records if record["error"]),
+                   "retries": sum(record["attempts"] - 1 for record in records)}
+        for field in ("latency", "first_token", "total"):
+            values = sorted(record[field] for record in records if record[field] is not None)
+            if values:
+                summary[field] = {"p50": values[len(values) // 2],
+                                  "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                                  "max": values[-1]}
+        return summary
+
+
+metrics = LatencyMetrics()
+
+
+def create_chat_completion(api_key, model, messages, cancel_event=None, **kwargs):
+    # Once cancel_event (a threading.Event) is set, a retry isn't waited for: the last
+    # error is raised right away
+    client = get_client(api_key)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            completion = client.chat.completions.create(model=model, messages=messages, **kwargs)
+            return completion, attempt, time.perf_counter() - start
+        except Exception as e:
+            if attempt > max_retries or not is_retryable(e):
+                metrics.record(model, attempt, time.perf_counter() - start, error=type(e).__name__)
+                raise
+            delay = backoff_delay(attempt - 1, e)
+            if cancel_event is None:
+                time.sleep(delay)
+            elif cancel_event.wait(delay):
+                metrics.record(model, attempt, time.perf_counter() - start, error="cancelled")
+                raise
+
+
+class MeteredStream:
+    # Iterates a streamed completion and records its timings once it ends
+    def __init__(self, stream, model, attempts, start, latency):
+        self.stream = stream
+        self.model = model
+        self.attempts = attempts
+        self.start = start
+        self.latency = latency
+        self.first_token = None
+        self.recorded = False
+
+    def __iter__(self):
+        error = None
+        try:
+            for chunk in self.stream:
+                if self.first_token is None:
+                    self.first_token = time.perf_counter() - self.start
+                yield chunk
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.finish(error)
+
+    def finish(self, error=None):
+        if not self.recorded:
+            self.recorded = True
+            total = time.perf_counter() - self.start
+            metrics.record(self.model, self.attempts, self.latency, self.first_token, total, error)
+            if error is None:
+                instrumentation.record("api.latency", self.latency)
+                if self.first_token is not None:
+                    instrumentation.record("api.first_token", self.first_token)
+                instrumentation.record("api.total", total)
+
+    def close(self):
+        self.stream.close()
+        self.finish("cancelled")
+
+
+def stream_chat_completion(api_key, model, messages, cancel_event=None):
+    start = time.perf_counter()
+    stream, attempts, latency = create_chat_completion(api_key, model, messages, cancel_event, stream=True)
+    return MeteredStream(stream, model, attempts, start, latency)
+
+
+def send_gpt_request(api_key, model, prompt, cancel_event=None):
+    completion, attempts, latency = create_chat_completion(api_key, model, [{"role": "user", "content": prompt}],
+                                                           cancel_event)
+    metrics.record(model, attempts, latency, total=latency)
+    return completion.choices[0].message.content
@@ -0,0 +1,65 @@
+# Measures load_chat_history latency as the total number of stored messages grows.
+# With the (session_id, id) index the latency should stay flat, since a session is
+# read with an index range scan regardless of how many other sessions exist.
+#
+#   python benchmarks/bench_chat_history.py --sizes 100 10000 1000000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+def populate(start, total_messages, session_size):
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO chat_sessions (session_id, chat_name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            ((f"session-{n}", f"session-{n}", now, now)
+             for n in range(start // session_size, (total_messages - 1) // session_size + 1)))
+        conn.executemany(
+            "INSERT INTO chats (session_id, message_role, message_content, model, created_at) VALUES (?, ?, ?, ?, ?)",
+            ((f"session-{i // session_size}", "user" if i % 2 == 0 else "assistant", f"message {i} " * 20, "gpt-4o",
+              now) for i in range(start, total_messages)))
+
+
+def measure(total_messages, session_size, repeat):
+    sessions = max(1, total_messages // session_size)
+    timings = []
+    for _ in range(repeat):
+        session_id = f"session-{random.randrange(sessions)}"
+        started = time.perf_counter()
+        storage.load_chat_history(session_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000, 1000000])
+    parser.add_argument("--session-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage.configure(os.path.join(directory, "settings.db"))
+        storage.initialize_database()
+
+        print(f"{'messages':>10} {'median ms':>10} {'max ms':>10}")
+        stored = 0
+        for size in sorted(args.sizes):
+            populate(stored, size, args.session_size)
+            stored = size
+            median, worst = measure(size, args.session_size, args.repeat)
+            print(f"{size:>10} {median:>10.3f} {worst:>10.3f}")
+        storage.close_connections()
+
+
+if __name__ == "__main__":
+    main()
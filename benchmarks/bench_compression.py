@@ -0,0 +1,149 @@
+# Measures what dictionary compression does to size and token counts, for several
+# dictionary sizes, and writes the results as JSON so runs can be compared.
+#
+# For every size it reports characters and tokens of the original texts, of the texts
+# after dictionary substitution alone, and after substitution plus base64 (what
+# compress_text returns), plus the tokens needed to send the dictionary itself, whether
+# every text survives decompress_text, and compression/decompression throughput.
+#
+# Token counts come from tokenizer.count_tokens: tiktoken if it is installed and its
+# encoding is cached (set TIKTOKEN_CACHE_DIR to run offline), an estimate otherwise.
+# The "tokenizer" field of the output says which one was used.
+#
+#   python benchmarks/bench_compression.py --corpus docs README.md --sizes 10 100 500 --output results.json
+#   python benchmarks/bench_compression.py --mode token_gain --sizes 100
+#   python benchmarks/bench_compression.py --db "%APPDATA%/GPTDesktopClient/settings.db"
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import storage  # noqa: E402
+import tokenizer  # noqa: E402
+from compression import build_compression_dictionary, compile_dictionary, compress_text, \
+    decompress_text  # noqa: E402
+
+CORPUS_EXTENSIONS = (".txt", ".md")
+
+
+def load_files(paths):
+    texts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                texts.extend(load_files(os.path.join(directory, name) for name in sorted(names)
+                                        if name.endswith(CORPUS_EXTENSIONS)))
+        else:
+            with open(path, encoding="utf-8") as corpus_file:
+                texts.append(corpus_file.read())
+    return [text for text in texts if text.strip()]
+
+
+def load_messages(db_path, limit):
+    # Through storage, so compressed message bodies are read as plaintext
+    storage.configure(db_path)
+    storage.initialize_database()
+    try:
+        return [row[0] for row in storage.get_connection().execute(
+            "SELECT message_content FROM chat_messages ORDER BY id LIMIT ?", (limit,)) if row[0]]
+    finally:
+        storage.close_connections()
+
+
+def count_tokens(texts):
+    return sum(tokenizer.count_tokens(text) for text in texts)
+
+
+def timed(function, texts, repeat):
+    # Best of `repeat` runs over all texts; returns (seconds, outputs)
+    best = None
+    outputs = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        outputs = [function(text) for text in texts]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+
+def measure(texts, top_n, mode, repeat, original_tokens, megabytes):
+    started = time.perf_counter()
+    dictionary = build_compression_dictionary(texts, top_n=top_n, mode=mode)
+    build_seconds = time.perf_counter() - started
+
+    engine = compile_dictionary(dictionary)
+    substituted = [engine.substitute(text) for text in texts]
+    compress_seconds, compressed = timed(lambda text: compress_text(text, dictionary), texts, repeat)
+    decompress_seconds, restored = timed(lambda text: decompress_text(text, dictionary), compressed, repeat)
+    failures = sum(1 for text, result in zip(texts, restored) if result != text)
+
+    substituted_tokens = count_tokens(substituted)
+    compressed_tokens = count_tokens(compressed)
+    # The model can only read substituted text if it is given the dictionary too
+    dictionary_tokens = count_tokens([f"{symbol}={phrase}" for phrase, symbol in dictionary.items()])
+    return {
+        "top_n": top_n,
+        "mode": mode,
+        "dictionary_entries": len(dictionary),
+        "dictionary_tokens": dictionary_tokens,
+        "build_seconds": round(build_seconds, 6),
+        "substituted_chars": sum(len(text) for text in substituted),
+        "compressed_chars": sum(len(text) for text in compressed),
+        "substituted_tokens": substituted_tokens,
+        "compressed_tokens": compressed_tokens,
+        "substituted_token_ratio": round(substituted_tokens / original_tokens, 4) if original_tokens else None,
+        "compressed_token_ratio": round(compressed_tokens / original_tokens, 4) if original_tokens else None,
+        "net_substituted_tokens": substituted_tokens + dictionary_tokens - original_tokens,
+        "round_trip_ok": failures == 0,
+        "round_trip_failures": failures,
+        "compress_mb_per_s": round(megabytes / compress_seconds, 3) if compress_seconds else None,
+        "decompress_mb_per_s": round(megabytes / decompress_seconds, 3) if decompress_seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", nargs="+", default=[os.path.join(ROOT, "docs"), os.path.join(ROOT, "README.md")],
+                        help="text/markdown files or directories; each file is one text")
+    parser.add_argument("--db", help="read the texts from the chats table of this settings.db instead")
+    parser.add_argument("--limit", type=int, default=100000, help="most messages read with --db")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 500])
+    parser.add_argument("--mode", nargs="+", choices=["frequency", "token_gain"], default=["frequency", "token_gain"],
+                        help="dictionary selection modes to compare")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    texts = load_messages(args.db, args.limit) if args.db else load_files(args.corpus)
+    if not texts:
+        parser.error("the corpus is empty")
+    original_chars = sum(len(text) for text in texts)
+    original_tokens = count_tokens(texts)
+    original_bytes = sum(len(text.encode("utf-8")) for text in texts)
+    megabytes = original_bytes / 1e6
+
+    results = {
+        "benchmark": "compression",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "tokenizer": f"tiktoken:{tokenizer.ENCODING_NAME}" if tokenizer.get_encoding() else "estimate",
+        "corpus": {"texts": len(texts), "chars": original_chars, "bytes": original_bytes,
+                   "tokens": original_tokens},
+        "runs": [measure(texts, top_n, mode, args.repeat, original_tokens, megabytes)
+                 for mode in args.mode for top_n in args.sizes],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Measures how long rendering a chat message to HTML takes and writes the results as
+# JSON so runs can be compared. Reports the first render (imports and converter set-up
+# included), per-message render time of render_markdown over the corpus, the same
+# messages served from the in-memory render cache, and building the stylesheet cold
+# and cached.
+#
+# Markdown files are split at their headings, so each section stands in for a message.
+#
+#   python benchmarks/bench_render.py --corpus docs README.md --repeat 5 --output render.json
+#   python benchmarks/bench_render.py --db "%APPDATA%/GPTDesktopClient/settings.db" --limit 2000
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rendering  # noqa: E402
+import storage  # noqa: E402
+
+CORPUS_EXTENSIONS = (".txt", ".md")
+
+
+def split_sections(text):
+    # Splits before every heading outside a fenced code block
+    sections = []
+    current = []
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith("```") or stripped.startswith("~~~"):
+            in_fence = not in_fence
+        elif line.startswith("#") and not in_fence and current:
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return sections
+
+
+def load_files(paths):
+    texts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                texts.extend(load_files(os.path.join(directory, name) for name in sorted(names)
+                                        if name.endswith(CORPUS_EXTENSIONS)))
+        else:
+            with open(path, encoding="utf-8") as corpus_file:
+                texts.extend(split_sections(corpus_file.read()))
+    return [text for text in texts if text.strip()]
+
+
+def load_messages(db_path, limit):
+    # Assistant messages are the ones rendered as markdown
+    storage.configure(db_path)
+    storage.initialize_database()
+    try:
+        return [row[0] for row in storage.get_connection().execute(
+            "SELECT message_content FROM chat_messages WHERE message_role = 'assistant' ORDER BY id LIMIT ?",
+            (limit,)) if row[0]]
+    finally:
+        storage.close_connections()
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 4)
+
+
+def distribution(timings):
+    ordered = sorted(timings)
+    return {"mean_ms": milliseconds(statistics.fmean(ordered)),
+            "p50_ms": milliseconds(ordered[len(ordered) // 2]),
+            "p95_ms": milliseconds(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]),
+            "max_ms": milliseconds(ordered[-1])}
+
+
+def time_each(function, texts, repeat):
+    # Best of `repeat` runs for every text, in seconds
+    best = [None] * len(texts)
+    for _ in range(repeat):
+        for index, text in enumerate(texts):
+            started = time.perf_counter()
+            function(text)
+            elapsed = time.perf_counter() - started
+            best[index] = elapsed if best[index] is None else min(best[index], elapsed)
+    return best
+
+
+def time_once(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", nargs="+", default=[os.path.join(ROOT, "docs"), os.path.join(ROOT, "README.md")],
+                        help="text/markdown files or directories; every section is one message")
+    parser.add_argument("--db", help="render the assistant messages of this settings.db instead")
+    parser.add_argument("--limit", type=int, default=1000, help="most messages read with --db")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    texts = load_messages(args.db, args.limit) if args.db else load_files(args.corpus)
+    if not texts:
+        parser.error("the corpus is empty")
+
+    first_render = time_once(rendering.render_markdown, texts[0])
+    stylesheet_cold = time_once(rendering.stylesheet)
+    stylesheet_cached = time_once(rendering.stylesheet)
+    renders = time_each(rendering.render_markdown, texts, args.repeat)
+    # Storage is not configured, so this only fills (and then reads) the memory tier
+    cached_texts = texts[:rendering.MEMORY_CACHE_SIZE]
+    rendering.render_markdown_many(cached_texts)
+    cached = time_each(rendering.render_markdown_cached, cached_texts, args.repeat)
+
+    chars = sum(len(text) for text in texts)
+    results = {
+        "benchmark": "render",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "renderer_version": rendering.RENDERER_VERSION,
+        "corpus": {"messages": len(texts), "chars": chars,
+                   "code_blocks": sum(text.count("```") // 2 for text in texts)},
+        "first_render_ms": milliseconds(first_render),
+        "stylesheet_cold_ms": milliseconds(stylesheet_cold),
+        "stylesheet_cached_ms": milliseconds(stylesheet_cached),
+        "render": dict(distribution(renders), chars_per_ms=round(chars / (sum(renders) * 1000), 1)),
+        "memory_cached_render": distribution(cached),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
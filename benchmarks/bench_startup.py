@@ -0,0 +1,158 @@
+# Measures cold start of the desktop client and writes the results as JSON so runs can
+# be compared. Every run starts a fresh interpreter with -X importtime and reports:
+#
+#   - time to first paint: until the main window (with the session list) is first
+#     painted, from process start and from the start of the client's own imports
+#   - time to ready: until the chat view exists and the background warm-up is done
+#   - the import time breakdown, per top-level package, of the slowest run, split into
+#     what was imported before the first paint and what was deferred until after it
+#
+#   python benchmarks/bench_startup.py --repeat 5 --output startup.json
+#   python benchmarks/bench_startup.py --appdata "%APPDATA%"   # with an existing history
+#   python benchmarks/bench_startup.py --platform offscreen     # without a display
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 120  # seconds a run may take before it is abandoned
+FIRST_PAINT_MARKER = "bench_startup: first paint"  # written between the -X importtime lines
+
+
+def run_client():
+    # Child process: starts the client the way `python gpt_desktop_client.py` does,
+    # records when it is painted and ready, quits and prints the timings
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from PyQt5.QtCore import QEvent, QObject, QTimer
+
+    import gpt_desktop_client
+    imported = time.perf_counter()
+    app, window = gpt_desktop_client.create_application([sys.argv[0]])
+    created = time.perf_counter()
+    timings = {}
+
+    class PaintWatcher(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Paint and "first_paint" not in timings:
+                timings["first_paint"] = time.perf_counter()
+                timings["first_paint_wall"] = time.time()
+                print(FIRST_PAINT_MARKER, file=sys.stderr, flush=True)
+            return False
+
+    def check_ready():
+        if window.warmed_up and window._chat_view is not None:
+            timings["ready"] = time.perf_counter()
+            app.quit()
+
+    watcher = PaintWatcher()
+    window.installEventFilter(watcher)
+    poll = QTimer()
+    poll.timeout.connect(check_ready)
+    poll.start(5)
+    app.exec_()
+
+    def elapsed(point):
+        return round((point - started) * 1000, 3) if point is not None else None
+
+    print(json.dumps({"import_ms": elapsed(imported),
+                      "window_created_ms": elapsed(created),
+                      "first_paint_ms": elapsed(timings.get("first_paint")),
+                      "first_paint_wall": timings.get("first_paint_wall"),
+                      "ready_ms": elapsed(timings.get("ready")),
+                      "sessions": window.chat_list_model.rowCount()}))
+
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package", nested imports indented.
+    # Returns {package: [self time before first paint, after it]} in microseconds.
+    packages = {}
+    phase = 0
+    for line in stderr.splitlines():
+        if line == FIRST_PAINT_MARKER:
+            phase = 1
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        packages.setdefault(package, [0, 0])[phase] += int(self_us)
+    return packages
+
+
+def run_once(appdata, qt_platform):
+    env = dict(os.environ, APPDATA=appdata)
+    if qt_platform:
+        env["QT_QPA_PLATFORM"] = qt_platform
+    launched = time.time()
+    process = subprocess.run([sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child"],
+                             cwd=ROOT, env=env, capture_output=True, text=True, timeout=TIMEOUT)
+    output = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not output:
+        raise RuntimeError(f"client exited with {process.returncode}:\n{process.stderr[-2000:]}")
+    result = json.loads(output[-1])
+    first_paint_wall = result.pop("first_paint_wall")
+    result["process_first_paint_ms"] = round((first_paint_wall - launched) * 1000, 3) \
+        if first_paint_wall is not None else None
+    packages = parse_importtime(process.stderr)
+    result["imports_before_paint_ms"] = round(sum(before for before, _ in packages.values()) / 1000, 3)
+    result["imports_after_paint_ms"] = round(sum(after for _, after in packages.values()) / 1000, 3)
+    return result, packages
+
+
+def summarize(runs, key):
+    values = [run[key] for run in runs if run[key] is not None]
+    if not values:
+        return None
+    return {"median": round(statistics.median(values), 3), "min": min(values), "max": max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--appdata", help="APPDATA directory to start with (default: an empty temporary one)")
+    parser.add_argument("--platform", help="QT_QPA_PLATFORM for the client, e.g. offscreen")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=25, help="packages listed in the import breakdown")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    if args.child:
+        run_client()
+        return
+
+    with tempfile.TemporaryDirectory() as temporary:
+        appdata = args.appdata or temporary
+        run_once(appdata, args.platform)  # creates the database and encryption key on a fresh APPDATA
+        measured = [run_once(appdata, args.platform) for _ in range(args.repeat)]
+
+    runs = [run for run, _ in measured]
+    _, slowest_packages = max(measured, key=lambda item: item[0]["first_paint_ms"] or 0)
+    breakdown = sorted(slowest_packages.items(), key=lambda item: -sum(item[1]))[:args.top]
+    results = {
+        "benchmark": "startup",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "summary": {key: summarize(runs, key) for key in
+                    ("import_ms", "first_paint_ms", "process_first_paint_ms", "ready_ms",
+                     "imports_before_paint_ms", "imports_after_paint_ms")},
+        "runs": runs,
+        "import_breakdown": [{"package": package, "before_paint_ms": round(before / 1000, 3),
+                              "after_paint_ms": round(after / 1000, 3)}
+                             for package, (before, after) in breakdown],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
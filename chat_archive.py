@@ -0,0 +1,239 @@
+# Streaming export and import of every chat session and message as JSON Lines, gzip
+# compressed when the file name ends in .gz. Rows are read with fetchmany and written
+# with executemany a batch at a time, so memory use stays flat however long the history
+# is. Run as a script to move chats between databases:
+#
+#   python chat_archive.py export chats.jsonl.gz --db "%APPDATA%/GPTDesktopClient/settings.db"
+#   python chat_archive.py import chats.jsonl.gz --db other/settings.db
+#
+# The first line is a header, followed by one line per session, then one per message:
+#
+#   {"format": "gpt-desktop-chats", "version": 1, "sessions": 2, "messages": 40}
+#   {"type": "session", "session_id": "...", "chat_name": "...", "created_at": ..., "updated_at": ...}
+#   {"type": "message", "session_id": "...", "role": "user", "content": "...", "model": "...",
+#    "created_at": ..., "token_count": ...}
+import argparse
+import gzip
+import json
+import os
+
+import storage
+from storage import get_connection, transaction
+
+FORMAT = "gpt-desktop-chats"
+VERSION = 1
+BATCH_SIZE = 1000  # rows per fetchmany/executemany
+
+
+def open_archive(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def batches(cursor, batch_size=BATCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def export_chats(path, progress=None, batch_size=BATCH_SIZE):
+    # progress(messages written, total messages) is called after every batch. Message
+    # bodies are read through chat_messages, so compressed ones are written as plaintext.
+    conn = get_connection()
+    conn.execute("BEGIN")  # one snapshot for the counts and rows; in WAL mode writers aren't blocked
+    try:
+        session_total, message_total = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM chat_sessions), (SELECT COUNT(*) FROM chats)").fetchone()
+        with open_archive(path, "w") as archive:
+            archive.write(json.dumps({"format": FORMAT, "version": VERSION, "sessions": session_total,
+                                      "messages": message_total}) + "\n")
+            for rows in batches(conn.execute(
+                    "SELECT session_id, chat_name, created_at, updated_at FROM chat_sessions ORDER BY rowid"),
+                    batch_size):
+                archive.writelines(
+                    json.dumps({"type": "session", "session_id": session_id, "chat_name": chat_name,
+                                "created_at": created_at, "updated_at": updated_at}, ensure_ascii=False) + "\n"
+                    for session_id, chat_name, created_at, updated_at in rows)
+            written = 0
+            for rows in batches(conn.execute(
+                    "SELECT session_id, message_role, message_content, model, created_at, token_count "
+                    "FROM chat_messages ORDER BY id"), batch_size):
+                archive.writelines(
+                    json.dumps({"type": "message", "session_id": session_id, "role": role, "content": content,
+                                "model": model, "created_at": created_at, "token_count": token_count},
+                               ensure_ascii=False) + "\n"
+                    for session_id, role, content, model, created_at, token_count in rows)
+                written += len(rows)
+                if progress:
+                    progress(written, message_total)
+    finally:
+        conn.rollback()
+    return {"sessions": session_total, "messages": message_total}
+
+
+def read_archive(archive):
+    # (header, iterator over the records) of an open archive
+    try:
+        header = json.loads(archive.readline() or "null")
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise ValueError("Not a chat export")
+    if header.get("version") != VERSION:
+        raise ValueError(f"Unsupported chat export version {header.get('version')}")
+    return header, (json.loads(line) for line in archive if line.strip())
+
+
+def import_chats(path, progress=None, batch_size=BATCH_SIZE):
+    # Adds the sessions and messages of an export, committing a batch at a time so the app
+    # can keep saving while a long import runs. If the import fails, the sessions it added
+    # are deleted again with their messages; only if the process dies midway do they stay
+    # (delete them before importing the file again). Sessions that already exist are
+    # skipped together with their messages, which makes importing the same file twice
+    # harmless. Messages are stored the way new messages are (compressed if that is
+    # enabled); the search index and session counters are kept up to date by the usual
+    # triggers. progress(messages read, total messages in the file) is called after every batch.
+    compression = storage.message_compression
+    sessions = []
+    messages = []
+    imported = {"sessions": 0, "messages": 0, "skipped_messages": 0}
+    read = 0
+    conn = get_connection()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_sessions (session_id TEXT PRIMARY KEY, existed INTEGER)")
+    conn.execute("DELETE FROM temp.import_sessions")
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chats").fetchone()[0]
+
+    def write_sessions():
+        with transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO temp.import_sessions SELECT ?1, "
+                             "EXISTS (SELECT 1 FROM chat_sessions WHERE session_id = ?1)",
+                             ((session[0],) for session in sessions))
+            cursor = conn.executemany(
+                "INSERT OR IGNORE INTO chat_sessions (session_id, chat_name, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?)", sessions)
+        imported["sessions"] += cursor.rowcount
+        sessions.clear()
+
+    def write_messages():
+        with transaction() as conn:
+            first_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chats").fetchone()[0]
+            cursor = conn.executemany(
+                "INSERT INTO chats (session_id, message_role, model, created_at, token_count, "
+                "message_content, content_blob, dictionary_id, content_codec) "
+                "SELECT :session_id, :role, :model, :created_at, :token_count, "
+                ":message_content, :content_blob, :dictionary_id, :content_codec "
+                "WHERE NOT EXISTS (SELECT 1 FROM temp.import_sessions WHERE session_id = :session_id AND existed)",
+                messages)
+            last_batch_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chats").fetchone()[0]
+            # A loaded index only follows messages saved through save_chat_messages; the
+            # new rows are only read if it is loaded
+            storage.after_commit(lambda: storage.update_tfidf_index(added=messages_after(first_id, last_batch_id)))
+        imported["messages"] += cursor.rowcount
+        imported["skipped_messages"] += len(messages) - cursor.rowcount
+        messages.clear()
+        if progress:
+            progress(read, total)
+
+    try:
+        with open_archive(path, "r") as archive:
+            header, records = read_archive(archive)
+            total = header.get("messages", 0)
+            for record in records:
+                record_type = record.get("type")
+                if record_type == "session":
+                    sessions.append((record["session_id"], record.get("chat_name"), record.get("created_at"),
+                                     record.get("updated_at")))
+                    if len(sessions) >= batch_size:
+                        write_sessions()
+                elif record_type == "message":
+                    if sessions:
+                        write_sessions()  # so messages of sessions that already existed are recognized
+                    content, blob, dictionary_id, codec = storage.encode_message(record["content"], compression)
+                    messages.append({"session_id": record["session_id"], "role": record.get("role"),
+                                     "model": record.get("model"), "created_at": record.get("created_at"),
+                                     "token_count": record.get("token_count"), "message_content": content,
+                                     "content_blob": blob, "dictionary_id": dictionary_id,
+                                     "content_codec": codec})
+                    read += 1
+                    if len(messages) >= batch_size:
+                        write_messages()
+                else:
+                    raise ValueError(f"Unknown record type in chat export: {record_type!r}")
+            if sessions:
+                write_sessions()
+            if messages:
+                write_messages()
+    except BaseException:
+        remove_imported(last_id)
+        raise
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.import_sessions")
+    return imported
+
+
+def remove_imported(last_id):
+    # Undoes a failed import_chats: deletes the sessions it added and the messages it
+    # added to them (ids above last_id)
+    new_sessions = "SELECT session_id FROM temp.import_sessions WHERE NOT existed"
+    with transaction() as conn:
+        message_ids = [row[0] for row in conn.execute(
+            f"SELECT id FROM chats WHERE id > ? AND session_id IN ({new_sessions})", (last_id,))]
+        conn.execute(f"DELETE FROM chats WHERE id > ? AND session_id IN ({new_sessions})", (last_id,))
+        conn.execute(f"DELETE FROM chat_sessions WHERE session_id IN ({new_sessions})")
+        storage.after_commit(lambda: storage.update_tfidf_index(removed=message_ids))
+
+
+def messages_after(last_id, up_to_id, batch_size=BATCH_SIZE):
+    # (id, text) of the messages with ids in (last_id, up_to_id], read a batch at a time
+    for rows in batches(get_connection().execute(
+            "SELECT id, message_content FROM chat_messages WHERE id > ? AND id <= ? ORDER BY id",
+            (last_id, up_to_id)), batch_size):
+        yield from rows
+
+
+def iter_corpus(source=None, roles=None, batch_size=BATCH_SIZE):
+    # Message texts, streamed from an export file or (source None) the database, e.g. as
+    # the texts for build_compression_dictionary; roles limits them to e.g. ("assistant",)
+    if source is None:
+        for rows in batches(get_connection().execute(
+                "SELECT message_role, message_content FROM chat_messages ORDER BY id"), batch_size):
+            for role, content in rows:
+                if content and (roles is None or role in roles):
+                    yield content
+        return
+    with open_archive(source, "r") as archive:
+        _, records = read_archive(archive)
+        for record in records:
+            if record.get("type") == "message" and record.get("content") and \
+                    (roles is None or record.get("role") in roles):
+                yield record["content"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import all chats as JSON Lines (.gz to compress)")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path")
+    parser.add_argument("--db", default=os.path.join(os.getenv("APPDATA", ""), "GPTDesktopClient", "settings.db"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    storage.configure(args.db)
+    storage.initialize_database()
+
+    def show_progress(done, total):
+        print(f"\r{done}/{total} messages", end="", flush=True)
+
+    if args.command == "export":
+        result = export_chats(args.path, show_progress, args.batch_size)
+    else:
+        result = import_chats(args.path, show_progress, args.batch_size)
+    print()
+    print(json.dumps(result, indent=2))
+    storage.close_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+
+from storage import load_chat_sessions_by_id, load_chat_sessions_page
+
+PAGE_SIZE = 200  # sessions read per fetchMore
+
+
+# Chat sessions for the sidebar, most recently active first. Rows are read a page at a
+# time as the list is scrolled (canFetchMore/fetchMore), so opening the window costs one
+# small query however many chats there are. Qt.DisplayRole is the chat name and
+# Qt.UserRole the session ID.
+class ChatListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.sessions = []  # [session_id, chat_name] in display order
+        self.rows = {}  # session_id -> row; rebuilt after rows are inserted, moved or removed
+        self.after = None  # (updated_at, rowid) of the last session read from the database
+        self.exhausted = False
+        self.filtered = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.sessions)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.sessions[index.row()][1]
+        if role == Qt.UserRole:
+            return self.sessions[index.row()][0]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        page = load_chat_sessions_page(self.after, PAGE_SIZE)
+        self.exhausted = len(page) < PAGE_SIZE
+        if page:
+            self.after = page[-1][2:]
+        # A session touched before its page was read is already shown
+        page = [row for row in page if self.row(row[0]) is None]
+        if not page:
+            return
+        first = len(self.sessions)
+        self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+        for row, (session_id, chat_name, _, _) in enumerate(page, first):
+            self.sessions.append([session_id, chat_name])
+            self.rows[session_id] = row
+        self.endInsertRows()
+
+    def reload(self):
+        # Back to the first page, e.g. when a search is cleared
+        self.beginResetModel()
+        self.sessions = []
+        self.rows = {}
+        self.after = None
+        self.exhausted = False
+        self.filtered = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def show_only(self, session_ids):
+        # Just these sessions (e.g. search results), in recency order
+        self.beginResetModel()
+        self.sessions = [[session_id, chat_name] for session_id, chat_name in load_chat_sessions_by_id(session_ids)]
+        self.rows = {session_id: row for row, (session_id, _) in enumerate(self.sessions)}
+        self.exhausted = True
+        self.filtered = True
+        self.endResetModel()
+
+    def row(self, session_id):
+        if self.rows is None:
+            self.rows = {session: row for row, (session, _) in enumerate(self.sessions)}
+        return self.rows.get(session_id)
+
+    def index_of(self, session_id):
+        row = self.row(session_id)
+        return QModelIndex() if row is None else self.index(row)
+
+    def touch(self, session_id, chat_name):
+        # The session has a new message: it moves to (or is added at) the top
+        row = self.row(session_id)
+        if row == 0:
+            return
+        if row is None:
+            self.beginInsertRows(QModelIndex(), 0, 0)
+            self.sessions.insert(0, [session_id, chat_name])
+            self.rows = None
+            self.endInsertRows()
+        else:
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), 0)
+            self.sessions.insert(0, self.sessions.pop(row))
+            self.rows = None
+            self.endMoveRows()
+
+    def rename(self, session_id, chat_name):
+        row = self.row(session_id)
+        if row is not None:
+            self.sessions[row][1] = chat_name
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+    def remove(self, session_id):
+        row = self.row(session_id)
+        if row is not None:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.sessions[row]
+            self.rows = None
+            self.endRemoveRows()
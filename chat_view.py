@@ -0,0 +1,89 @@
+import json
+
+from PyQt5.QtCore import QObject, QUrl, pyqtSignal, pyqtSlot
+from PyQt5.QtWebChannel import QWebChannel
+from PyQt5.QtWebEngineWidgets import QWebEngineView
+
+from rendering import chat_document
+
+
+class ChatBridge(QObject):
+    scrolled_to_top = pyqtSignal()
+    scrolled_to_bottom = pyqtSignal()
+    copy_requested = pyqtSignal(int)
+
+    @pyqtSlot()
+    def scrolledToTop(self):
+        self.scrolled_to_top.emit()
+
+    @pyqtSlot()
+    def scrolledToBottom(self):
+        self.scrolled_to_bottom.emit()
+
+    @pyqtSlot(int)
+    def copyMessage(self, message_id):
+        self.copy_requested.emit(message_id)
+
+
+# The whole conversation lives in one persistent document. The stylesheet and scripts
+# are loaded once and messages are added and removed with incremental DOM updates, so
+# a message costs a DOM node instead of a Chromium render surface.
+class ChatView(QWebEngineView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.bridge = ChatBridge(self)
+        self.scrolled_to_top = self.bridge.scrolled_to_top
+        self.scrolled_to_bottom = self.bridge.scrolled_to_bottom
+        self.copy_requested = self.bridge.copy_requested
+
+        self.channel = QWebChannel(self)
+        self.channel.registerObject("bridge", self.bridge)
+        self.page().setWebChannel(self.channel)
+
+        # Scripts run before the document has loaded are queued until it has
+        self.ready = False
+        self.pending_scripts = []
+        self.loadFinished.connect(self.on_load_finished)
+        self.setHtml(chat_document(), QUrl("qrc:///"))
+
+    def on_load_finished(self, ok):
+        self.ready = True
+        for script in self.pending_scripts:
+            self.page().runJavaScript(script)
+        self.pending_scripts = []
+
+    def run_script(self, script):
+        if self.ready:
+            self.page().runJavaScript(script)
+        else:
+            self.pending_scripts.append(script)
+
+    def append_messages(self, messages, scroll_to_end=True):
+        # messages: dicts with the message id, role and rendered html (and optionally cached)
+        self.run_script(f"appendMessages({json.dumps(messages)}, {json.dumps(scroll_to_end)})")
+
+    def prepend_messages(self, messages):
+        self.run_script(f"prependMessages({json.dumps(messages)})")
+
+    def remove_messages(self, count, from_top):
+        self.run_script(f"removeMessages({count}, {json.dumps(from_top)})")
+
+    def start_stream(self, prompt_html):
+        self.run_script(f"startStream({json.dumps(prompt_html)})")
+
+    def update_stream(self, finished_html, tail_html):
+        self.run_script(f"updateStream({json.dumps(finished_html)}, {json.dumps(tail_html)})")
+
+    def finish_stream(self, message_ids, html, cached=False):
+        # cached marks a response answered from the response cache
+        prompt_id, response_id = message_ids
+        self.run_script(f"finishStream({prompt_id}, {response_id}, {json.dumps(html)}, {json.dumps(cached)})")
+
+    def cancel_stream(self):
+        self.run_script("cancelStream()")
+
+    def clear_messages(self):
+        self.run_script("clearMessages()")
+
+    def scroll_to_message(self, message_id):
+        self.run_script(f"scrollToMessage({message_id})")
@@ -1,31 +1,389 @@
 import base64
-from frequency_analysis import get_frequent_words, get_frequent_ngrams
+import re
+import threading
+import zlib
+from functools import cached_property, lru_cache
 
-def build_compression_dictionary(texts, top_n=100):
-    all_text = ' '.join(texts)
-    frequent_words = get_frequent_words(all_text, top_n)
-    frequent_phrases = get_frequent_ngrams(all_text, 2, top_n)
+import dictionary_format
+from dictionary_format import MappedDictionary, find_dictionary, split_payload, tag_payload
+from frequency_analysis import build_corpus_statistics, count_phrases
+from instrumentation import timed
+from tokenizer import count_tokens
 
+# Symbols produced by build_compression_dictionary
+SYMBOL_PATTERN = re.compile(r'__[WP]\d+__')
+BYTES_SYMBOL_PATTERN = re.compile(SYMBOL_PATTERN.pattern.encode('ascii'))
+
+ENCODINGS = ("raw", "base64", "base85")
+CODECS = (None, "zlib", "zstd")  # zstd needs the optional zstandard package
+
+
+@timed()
+def build_compression_dictionary(texts, top_n=100, max_items=None, workers=1, chunk_size=256, mode="frequency",
+                                 max_n=3, dictionary_budget=None):
+    # texts may be any iterable (e.g. a cursor over the chats table); each text is
+    # tokenized once and never joined into a single corpus string. With workers != 1
+    # chunks of texts are counted in a process pool; the result is identical to the
+    # serial one as long as max_items is not set.
+    # mode="token_gain" picks phrases by the tokens they actually save instead (see
+    # token_gain_dictionary); max_n and dictionary_budget only apply to that mode.
+    if mode == "token_gain":
+        return token_gain_dictionary(texts, top_n, max_n, dictionary_budget)
+    if mode != "frequency":
+        raise ValueError(f"Unknown dictionary mode: {mode}")
+    if max_items is not None:
+        max_items = max(max_items, top_n)
+    stats = build_corpus_statistics(texts, n=2, max_items=max_items, workers=workers, chunk_size=chunk_size)
+    return dictionary_from_statistics(stats, top_n)
+
+
+def dictionary_from_statistics(stats, top_n=100):
     dictionary = {}
-    for i, (word, _) in enumerate(frequent_words):
+    for i, (word, _) in enumerate(stats.most_common_words(top_n)):
         dictionary[word] = f"__W{i}__"
-    for i, ((word1, word2), _) in enumerate(frequent_phrases):
+    for i, ((word1, word2), _) in enumerate(stats.most_common_ngrams(top_n)):
         phrase = f"{word1} {word2}"
         dictionary[phrase] = f"__P{i}__"
 
     return dictionary
 
 
-def compress_text(text, dictionary):
-    for phrase, symbol in dictionary.items():
-        text = text.replace(phrase, symbol)
-    compressed_text = base64.b64encode(text.encode('utf-8')).decode('utf-8')
-    return compressed_text
+def _overlaps(phrase, other):
+    # True if the two token tuples could claim the same text: one contains the other,
+    # or the end of one is the start of the other
+    if len(phrase) > len(other):
+        phrase, other = other, phrase
+    if any(other[i:i + len(phrase)] == phrase for i in range(len(other) - len(phrase) + 1)):
+        return True
+    return any(phrase[-k:] == other[:k] or other[-k:] == phrase[:k] for k in range(1, len(phrase)))
+
+
+@timed()
+def token_gain_dictionary(texts, top_n=100, max_n=3, dictionary_budget=None, candidates_per_entry=20):
+    # Scores every phrase of 1..max_n tokens by its net token gain,
+    #   count * (tokens(phrase) - tokens(symbol)) - tokens(dictionary entry),
+    # and greedily keeps the best non-overlapping phrases with a positive gain, up to
+    # top_n entries and dictionary_budget tokens for the dictionary itself. Phrases that
+    # are one token already (most words, punctuation) can never gain and are skipped.
+    # The engine only replaces whole words, so the counts are the occurrences it replaces.
+    phrases = count_phrases(texts, max_n)
+    # Tokenizing is the slow part: only score the phrases covering the most characters
+    phrases.sort(key=lambda item: (-item[1] * len(item[0]), item[0]))
+    del phrases[top_n * candidates_per_entry:]
+
+    # Symbols are numbered in selection order; price every one as the longest
+    word_symbol_tokens = count_tokens(f" __W{top_n - 1}__")
+    phrase_symbol_tokens = count_tokens(f" __P{top_n - 1}__")
+    scored = []
+    for phrase, count in phrases:
+        if SYMBOL_PATTERN.search(phrase):
+            continue
+        tokens = tuple(phrase.split(" "))
+        symbol_tokens = word_symbol_tokens if len(tokens) == 1 else phrase_symbol_tokens
+        overhead = count_tokens(f"__P{top_n - 1}__={phrase}\n")
+        gain = count * (count_tokens(" " + phrase) - symbol_tokens) - overhead
+        if gain > 0:
+            scored.append((gain, phrase, tokens, overhead))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+
+    dictionary = {}
+    selected_by_token = {}  # token -> selected token tuples containing it
+    words = 0
+    budget_used = 0
+    for gain, phrase, tokens, overhead in scored:
+        if len(dictionary) >= top_n:
+            break
+        if dictionary_budget is not None and budget_used + overhead > dictionary_budget:
+            continue
+        if any(_overlaps(tokens, other) for token in set(tokens) for other in selected_by_token.get(token, ())):
+            continue
+        if len(tokens) == 1:
+            dictionary[phrase] = f"__W{words}__"
+            words += 1
+        else:
+            dictionary[phrase] = f"__P{len(dictionary) - words}__"
+        budget_used += overhead
+        for token in set(tokens):
+            selected_by_token.setdefault(token, []).append(tokens)
+    return dictionary
+
+
+def _build_trie(keys):
+    trie = {}
+    for key in keys:
+        if not key:
+            continue
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True  # end-of-key marker
+    return trie
+
+
+# Phrases only match whole words: one that starts (ends) with a word character never
+# matches right after (before) another. Anything non-ASCII counts as a word character,
+# so matching a text and matching its UTF-8 bytes give the same result.
+WORD_CLASS = r'[0-9A-Za-z_\x80-\U0010ffff]'
+BYTES_WORD_CLASS = r'[0-9A-Za-z_\x80-\xff]'
+
+
+def _is_word_char(char):
+    return not char.isascii() or char.isalnum() or char == '_'
+
+
+def _trie_to_regex(node, word_class=None, root=True):
+    # Children are tried before the end-of-key marker and each branch starts with a
+    # distinct character, so the regex engine always yields the longest key at the
+    # leftmost position.
+    branches = []
+    for char in sorted(key for key in node if key):
+        literal = char
+        child = node[char]
+        while len(child) == 1 and '' not in child:
+            (next_char, child), = child.items()
+            literal += next_char
+        branches.append(re.escape(literal) + _trie_to_regex(child, word_class, False))
+    if word_class and root:
+        # Keys starting with a word character share one lookbehind
+        word_branches = [branch for branch in branches if _is_word_char(branch[0])]
+        if word_branches:
+            branches = [branch for branch in branches if not _is_word_char(branch[0])]
+            branches.insert(0, f'(?<!{word_class})(?:' + '|'.join(word_branches) + ')')
+    if not branches:
+        return ''
+    alternation = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        if len(branches) == 1:
+            alternation = '(?:' + alternation + ')'
+        return alternation + '?'
+    return alternation
+
+
+def _whole_words_pattern(trie, word_class):
+    # One end check for every key: a key that ends with a word character must not be
+    # followed by one. A failed check backtracks into the trie, to the next shorter key.
+    # Repeating the check at each key end made compiling large dictionaries take seconds.
+    return f'(?:{_trie_to_regex(trie, word_class)})(?:(?<!{word_class})|(?!{word_class}))'
+
+
+def _compile_matcher(keys, whole_words=False):
+    trie = _build_trie(keys)
+    if not trie:
+        return None
+    pattern = _whole_words_pattern(trie, WORD_CLASS) if whole_words else _trie_to_regex(trie)
+    return re.compile(pattern, re.DOTALL)
+
+
+def _compile_bytes_matcher(keys, whole_words=False):
+    # Same matcher over UTF-8 bytes: each byte is spelled as the latin-1 character with
+    # that code, so the str regex encodes to the equivalent bytes regex. UTF-8 keys can
+    # only match on character boundaries, so the result equals matching the text.
+    trie = _build_trie(key.decode('latin-1') for key in keys)
+    if not trie:
+        return None
+    pattern = _whole_words_pattern(trie, BYTES_WORD_CLASS) if whole_words else _trie_to_regex(trie)
+    return re.compile(pattern.encode('latin-1'), re.DOTALL)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("The zstd codec needs the zstandard package") from None
+    return zstandard
+
+
+def encode_payload(data, encoding="raw", codec=None, level=None):
+    if codec == "zlib":
+        data = zlib.compress(data, 6 if level is None else level)
+    elif codec == "zstd":
+        data = _zstd().ZstdCompressor(level=3 if level is None else level).compress(data)
+    elif codec is not None:
+        raise ValueError(f"Unknown codec: {codec}")
+    if encoding == "base64":
+        return base64.b64encode(data)
+    if encoding == "base85":
+        return base64.b85encode(data)
+    if encoding != "raw":
+        raise ValueError(f"Unknown encoding: {encoding}")
+    return data
+
+
+def decode_payload(data, encoding="raw", codec=None):
+    if encoding == "base64":
+        data = base64.b64decode(data)
+    elif encoding == "base85":
+        data = base64.b85decode(data)
+    elif encoding != "raw":
+        raise ValueError(f"Unknown encoding: {encoding}")
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        return _zstd().ZstdDecompressor().decompress(data)
+    if codec is not None:
+        raise ValueError(f"Unknown codec: {codec}")
+    return data
+
+
+# Matches every dictionary phrase in a single left-to-right pass (leftmost-longest),
+# so the output does not depend on dictionary order. Build once, reuse for every text.
+# Each direction's tables are built on first use, so an engine that only decompresses
+# never compiles the phrase matcher, and a MappedDictionary is only read when needed.
+class CompressionEngine:
+    def __init__(self, dictionary):
+        if isinstance(dictionary, MappedDictionary):
+            self.mapped = dictionary
+        else:
+            self.mapped = None
+            self.dictionary = dict(dictionary)
+
+    @cached_property
+    def dictionary(self):
+        return self.mapped.dictionary
+
+    @cached_property
+    def reverse_dictionary(self):
+        if self.mapped is not None:
+            return self.mapped.reverse_dictionary
+        return {symbol: phrase for phrase, symbol in self.dictionary.items()}
+
+    @cached_property
+    def dictionary_id(self):
+        return dictionary_format.dictionary_id(self.mapped or self.dictionary)
+
+    @cached_property
+    def _phrase_matcher(self):
+        return _compile_matcher(self.dictionary, whole_words=True)
+
+    @cached_property
+    def _symbol_matcher(self):
+        if all(SYMBOL_PATTERN.fullmatch(symbol) for symbol in self.reverse_dictionary):
+            return SYMBOL_PATTERN
+        return _compile_matcher(self.reverse_dictionary)
+
+    def substitute(self, text):
+        if self._phrase_matcher is None:
+            return text
+        dictionary = self.dictionary
+        return self._phrase_matcher.sub(lambda match: dictionary[match.group()], text)
+
+    def expand(self, text):
+        if self._symbol_matcher is None:
+            return text
+        reverse_dictionary = self.reverse_dictionary
+        return self._symbol_matcher.sub(
+            lambda match: reverse_dictionary.get(match.group(), match.group()), text)
+
+    @cached_property
+    def _bytes_dictionary(self):
+        return {phrase.encode('utf-8'): symbol.encode('utf-8') for phrase, symbol in self.dictionary.items()}
+
+    @cached_property
+    def _bytes_reverse_dictionary(self):
+        return {symbol.encode('utf-8'): phrase.encode('utf-8') for symbol, phrase in self.reverse_dictionary.items()}
+
+    @cached_property
+    def _bytes_phrase_matcher(self):
+        return _compile_bytes_matcher(self._bytes_dictionary, whole_words=True)
+
+    @cached_property
+    def _bytes_symbol_matcher(self):
+        if self._symbol_matcher is SYMBOL_PATTERN:
+            return BYTES_SYMBOL_PATTERN
+        return _compile_bytes_matcher(self._bytes_reverse_dictionary)
+
+    def substitute_bytes(self, data):
+        # data: UTF-8 bytes, bytearray or memoryview; matched in place, never decoded
+        if self._bytes_phrase_matcher is None:
+            return bytes(data)
+        dictionary = self._bytes_dictionary
+        return self._bytes_phrase_matcher.sub(lambda match: dictionary[match.group()], data)
+
+    def expand_bytes(self, data):
+        if self._bytes_symbol_matcher is None:
+            return bytes(data)
+        reverse_dictionary = self._bytes_reverse_dictionary
+        return self._bytes_symbol_matcher.sub(
+            lambda match: reverse_dictionary.get(match.group(), match.group()), data)
+
+    def compress_bytes(self, data, encoding="raw", codec=None, level=None):
+        # Substitution, then the optional codec, then the output encoding. "raw" skips
+        # the text encoding entirely (no base64 inflation), e.g. for local storage.
+        return encode_payload(self.substitute_bytes(data), encoding, codec, level)
+
+    def decompress_bytes(self, data, encoding="raw", codec=None):
+        return self.expand_bytes(decode_payload(data, encoding, codec))
+
+    def compress(self, text, tag=False):
+        # tag=True prefixes the dictionary ID, so the payload can be decompressed
+        # without passing the dictionary (see decompress_text)
+        payload = base64.b64encode(self.substitute(text).encode('utf-8')).decode('utf-8')
+        return tag_payload(self.dictionary_id, payload) if tag else payload
+
+    def decompress(self, compressed_text):
+        payload_dictionary_id, compressed_text = split_payload(compressed_text)
+        if payload_dictionary_id is not None and payload_dictionary_id != self.dictionary_id:
+            raise ValueError(f"Payload was compressed with dictionary {payload_dictionary_id}, "
+                             f"not {self.dictionary_id}")
+        return self.expand(base64.b64decode(compressed_text).decode('utf-8'))
+
+
+@lru_cache(maxsize=8)
+def _cached_engine(items):
+    return CompressionEngine(items)
+
+
+# Plain dicts are looked up by identity so a repeat call doesn't hash every item again. The entry keeps the dict
+# alive (its id can't be reused) and a copy of it, so a dictionary edited in place still gets a fresh engine.
+_dict_engines = {}
+_dict_engines_lock = threading.Lock()
+
+
+def _dict_engine(dictionary):
+    with _dict_engines_lock:
+        entry = _dict_engines.get(id(dictionary))
+    if entry is not None and entry[0] is dictionary and entry[1] == dictionary:
+        return entry[2]
+    snapshot = dict(dictionary)
+    engine = _cached_engine(tuple(snapshot.items()))
+    with _dict_engines_lock:
+        _dict_engines.pop(id(dictionary), None)
+        _dict_engines[id(dictionary)] = (dictionary, snapshot, engine)
+        while len(_dict_engines) > 8:
+            del _dict_engines[next(iter(_dict_engines))]
+    return engine
+
+
+def compile_dictionary(dictionary):
+    if isinstance(dictionary, CompressionEngine):
+        return dictionary
+    if isinstance(dictionary, MappedDictionary):
+        return _cached_engine(dictionary)
+    return _dict_engine(dictionary)
+
+
+@timed()
+def compress_text(text, dictionary, tag=False):
+    return compile_dictionary(dictionary).compress(text, tag)
+
+
+@timed()
+def compress_bytes(data, dictionary, encoding="raw", codec=None, level=None):
+    return compile_dictionary(dictionary).compress_bytes(data, encoding, codec, level)
+
+
+@timed()
+def decompress_bytes(data, dictionary, encoding="raw", codec=None):
+    return compile_dictionary(dictionary).decompress_bytes(data, encoding, codec)
 
 
-def decompress_text(compressed_text, dictionary):
-    text = base64.b64decode(compressed_text).decode('utf-8')
-    reverse_dictionary = {v: k for k, v in dictionary.items()}
-    for symbol, phrase in reverse_dictionary.items():
-        text = text.replace(symbol, phrase)
-    return text
+@timed()
+def decompress_text(compressed_text, dictionary=None):
+    # Without a dictionary, the one named by the payload's tag is used; it must have
+    # been loaded with dictionary_format.load_dictionary or registered
+    if dictionary is None:
+        payload_dictionary_id, _ = split_payload(compressed_text)
+        if payload_dictionary_id is None:
+            raise ValueError("Payload has no dictionary ID; pass the dictionary")
+        dictionary = find_dictionary(payload_dictionary_id)
+    return compile_dictionary(dictionary).decompress(compressed_text)
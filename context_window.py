@@ -0,0 +1,92 @@
+from tokenizer import MESSAGE_OVERHEAD, REPLY_OVERHEAD, count_message_tokens, count_tokens
+
+MODEL_CONTEXT_LIMITS = {"gpt-3.5-turbo": 16385, "gpt-4": 8192, "gpt-4o": 128000}
+DEFAULT_CONTEXT_LIMIT = 8192
+RESPONSE_RESERVE = 1024  # tokens of the context window left for the reply
+SUMMARY_BUDGET = 256  # most tokens spent on the summary of dropped turns
+SUMMARY_LINE_LENGTH = 120
+
+budgets = {}  # model -> configured budget for the request, in tokens
+savings = {"requests": 0, "history_tokens": 0, "sent_tokens": 0, "saved_tokens": 0}
+
+
+def context_budget(model):
+    limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT) - RESPONSE_RESERVE
+    budget = budgets.get(model)
+    return min(budget, limit) if budget else limit
+
+
+def message_tokens(message):
+    # Counted once per message; callers persist new counts in chats.token_count
+    if message.get("tokens") is None:
+        message["tokens"] = count_message_tokens(message["content"])
+    return message["tokens"]
+
+
+def summarize_turns(messages, budget):
+    # Local summary of dropped turns, so it costs no extra request: the opening line of
+    # each earlier prompt, newest first while they fit, listed oldest first
+    header = "Summary of the earlier conversation. The user previously asked:"
+    used = count_tokens(header) + MESSAGE_OVERHEAD
+    lines = []
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        first_line = message["content"].strip().split("\n", 1)[0][:SUMMARY_LINE_LENGTH]
+        if not first_line:
+            continue
+        line = "- " + first_line
+        tokens = count_tokens(line) + 1
+        if used + tokens > budget:
+            break
+        lines.append(line)
+        used += tokens
+    if not lines:
+        return None, 0
+    return header + "\n" + "\n".join(reversed(lines)), used
+
+
+def build_context(history, user_prompt, model, budget=None, summarize=True):
+    # Returns the messages to send and a report of the tokens saved. The most recent
+    # turns are kept verbatim while they fit in the budget; older turns are dropped and,
+    # if summarize is set, replaced by a short summary.
+    budget = context_budget(model) if budget is None else budget
+    prompt_tokens = count_message_tokens(user_prompt) + REPLY_OVERHEAD
+    history_tokens = sum(message_tokens(message) for message in history)
+    available = budget - prompt_tokens
+
+    # Whole turns only, newest first; a turn starts at a user message
+    used = 0
+    start = len(history)
+    while start > 0:
+        turn_start = start - 1
+        while turn_start > 0 and history[turn_start]["role"] != "user":
+            turn_start -= 1
+        turn_tokens = sum(message_tokens(message) for message in history[turn_start:start])
+        if used + turn_tokens > available:
+            break
+        used += turn_tokens
+        start = turn_start
+
+    messages = []
+    summary_tokens = 0
+    if start and summarize:
+        summary, summary_tokens = summarize_turns(history[:start], min(SUMMARY_BUDGET, available - used))
+        if summary:
+            messages.append({"role": "system", "content": summary})
+    messages.extend({"role": message["role"], "content": message["content"]} for message in history[start:])
+    messages.append({"role": "user", "content": user_prompt})
+
+    sent_tokens = used + summary_tokens + prompt_tokens
+    report = {"budget": budget,
+              "history_tokens": history_tokens,
+              "sent_tokens": sent_tokens,
+              "saved_tokens": history_tokens + prompt_tokens - sent_tokens,
+              "kept_messages": len(history) - start,
+              "dropped_messages": start,
+              "summarized": summary_tokens > 0}
+    savings["requests"] += 1
+    savings["history_tokens"] += history_tokens
+    savings["sent_tokens"] += sent_tokens
+    savings["saved_tokens"] += report["saved_tokens"]
+    return messages, report
@@ -0,0 +1,195 @@
+import hashlib
+import mmap
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping
+from functools import cached_property
+
+import numpy as np
+
+# Binary compression dictionary, little-endian:
+#   header: magic, format version, flags, entry count, body size, SHA-256 of the body
+#   body:   phrase offsets (count + 1 x u32), symbol offsets (count + 1 x u32),
+#           entry indexes in symbol order (count x u32), phrase bytes, symbol bytes
+# Entries are sorted by the UTF-8 bytes of their phrase, so the same dictionary always
+# encodes to the same bytes and its ID (the start of the body hash) does not depend on
+# the order it was built in. Strings are only decoded when looked up.
+MAGIC = b"TRDX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII32s")
+ID_BYTES = 8
+
+# Compressed payloads can carry the ID of their dictionary: "#D<id>:<payload>".
+# Only base64 payloads are tagged: '#' is outside the base64 alphabet, so an untagged
+# one never matches, but it is part of the base85 alphabet.
+PAYLOAD_TAG = "#D"
+
+_registry = {}  # dictionary ID -> dictionary, for decompressing tagged payloads
+
+
+def encode_dictionary(dictionary):
+    entries = sorted((phrase.encode("utf-8"), symbol.encode("utf-8")) for phrase, symbol in dictionary.items())
+    phrase_offsets = np.zeros(len(entries) + 1, dtype="<u4")
+    symbol_offsets = np.zeros(len(entries) + 1, dtype="<u4")
+    np.cumsum([len(phrase) for phrase, _ in entries], out=phrase_offsets[1:])
+    np.cumsum([len(symbol) for _, symbol in entries], out=symbol_offsets[1:])
+    symbol_order = np.array(sorted(range(len(entries)), key=lambda i: entries[i][1]), dtype="<u4")
+    body = b"".join([phrase_offsets.tobytes(), symbol_offsets.tobytes(), symbol_order.tobytes(),
+                     b"".join(phrase for phrase, _ in entries), b"".join(symbol for _, symbol in entries)])
+    header = HEADER.pack(MAGIC, VERSION, 0, len(entries), len(body), hashlib.sha256(body).digest())
+    return header + body
+
+
+def dictionary_id(dictionary):
+    if isinstance(dictionary, MappedDictionary):
+        return dictionary.dictionary_id
+    return HEADER.unpack_from(encode_dictionary(dictionary))[5][:ID_BYTES].hex()
+
+
+def save_dictionary(dictionary, path):
+    with open(path, "wb") as dictionary_file:
+        dictionary_file.write(encode_dictionary(dictionary))
+
+
+# Read-only phrase -> symbol mapping over an encoded dictionary (usually a memory-mapped
+# file). Opening it only parses the header; lookups binary-search the offset tables,
+# and the full forward and reverse dicts are built the first time they are asked for.
+class MappedDictionary(Mapping):
+    def __init__(self, buffer, verify=False):
+        self._mmap = buffer if isinstance(buffer, mmap.mmap) else None
+        self.buffer = memoryview(buffer)
+        if len(self.buffer) < HEADER.size:
+            raise ValueError("Not a compression dictionary: file too short")
+        magic, version, _, count, body_size, digest = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError("Not a compression dictionary: bad magic")
+        if version != VERSION:
+            raise ValueError(f"Unsupported compression dictionary version {version}")
+        if len(self.buffer) < HEADER.size + body_size:
+            raise ValueError("Compression dictionary is truncated")
+        if verify and hashlib.sha256(self.buffer[HEADER.size:HEADER.size + body_size]).digest() != digest:
+            raise ValueError("Compression dictionary is corrupt: content hash mismatch")
+
+        self.dictionary_id = digest[:ID_BYTES].hex()
+        self.count = count
+        offset = HEADER.size
+        self.phrase_offsets = np.frombuffer(self.buffer, dtype="<u4", count=count + 1, offset=offset)
+        offset += 4 * (count + 1)
+        self.symbol_offsets = np.frombuffer(self.buffer, dtype="<u4", count=count + 1, offset=offset)
+        offset += 4 * (count + 1)
+        self.symbol_order = np.frombuffer(self.buffer, dtype="<u4", count=count, offset=offset)
+        self.phrase_base = offset + 4 * count
+        self.symbol_base = self.phrase_base + int(self.phrase_offsets[-1])
+
+    def _slice(self, base, offsets, index):
+        return self.buffer[base + int(offsets[index]):base + int(offsets[index + 1])]
+
+    def _raw_phrase(self, index):
+        return self._slice(self.phrase_base, self.phrase_offsets, index).tobytes()
+
+    def _raw_symbol(self, index):
+        return self._slice(self.symbol_base, self.symbol_offsets, index).tobytes()
+
+    def phrase(self, index):
+        return str(self._slice(self.phrase_base, self.phrase_offsets, index), "utf-8")
+
+    def symbol(self, index):
+        return str(self._slice(self.symbol_base, self.symbol_offsets, index), "utf-8")
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.phrase(index) for index in range(self.count))
+
+    def __getitem__(self, phrase):
+        if "dictionary" in self.__dict__:
+            return self.dictionary[phrase]
+        key = phrase.encode("utf-8")
+        index = bisect_left(_Sequence(self.count, self._raw_phrase), key)
+        if index < self.count and self._raw_phrase(index) == key:
+            return self.symbol(index)
+        raise KeyError(phrase)
+
+    def items(self):
+        return ((self.phrase(index), self.symbol(index)) for index in range(self.count))
+
+    def lookup_symbol(self, symbol):
+        # The phrase for a symbol, without building the reverse map; None if unknown
+        if "reverse_dictionary" in self.__dict__:
+            return self.reverse_dictionary.get(symbol)
+        key = symbol.encode("utf-8")
+        position = bisect_left(_Sequence(self.count, lambda i: self._raw_symbol(int(self.symbol_order[i]))), key)
+        if position < self.count:
+            index = int(self.symbol_order[position])
+            if self._raw_symbol(index) == key:
+                return self.phrase(index)
+        return None
+
+    @cached_property
+    def dictionary(self):
+        return dict(self.items())
+
+    @cached_property
+    def reverse_dictionary(self):
+        return {symbol: phrase for phrase, symbol in self.items()}
+
+    def close(self):
+        # numpy views hold buffer exports; drop them before the map can be closed
+        self.phrase_offsets = self.symbol_offsets = self.symbol_order = None
+        self.buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+
+class _Sequence:
+    # Lazy indexable view for bisect
+    def __init__(self, length, item):
+        self.length = length
+        self.item = item
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.item(index)
+
+
+def load_dictionary(path, verify=False):
+    # Maps the file instead of reading it; the dictionary is registered under its ID
+    with open(path, "rb") as dictionary_file:
+        buffer = mmap.mmap(dictionary_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return register_dictionary(MappedDictionary(buffer, verify=verify))
+
+
+def register_dictionary(dictionary):
+    _registry[dictionary_id(dictionary)] = dictionary
+    return dictionary
+
+
+def find_dictionary(dictionary_id):
+    try:
+        return _registry[dictionary_id]
+    except KeyError:
+        raise KeyError(f"No compression dictionary with ID {dictionary_id} is loaded") from None
+
+
+def tag_payload(dictionary_id, payload, encoding="base64"):
+    if encoding != "base64":
+        raise ValueError(f"Only base64 payloads can be tagged, not {encoding}")
+    return f"{PAYLOAD_TAG}{dictionary_id}:{payload}"
+
+
+def split_payload(payload):
+    # (dictionary ID or None, payload without the tag)
+    if payload.startswith(PAYLOAD_TAG):
+        tag_end = payload.find(":", len(PAYLOAD_TAG))
+        if tag_end != -1:
+            return payload[len(PAYLOAD_TAG):tag_end], payload[tag_end + 1:]
+    return None, payload
@@ -1,25 +1,220 @@
-from collections import Counter
-from nltk import ngrams
-from nltk.tokenize import word_tokenize
-from sklearn.feature_extraction.text import TfidfVectorizer
+import heapq
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
+import numpy as np
+
+from instrumentation import timed
+
+
+# NLTK and scikit-learn take most of this module's import time; they load on first use
+def word_tokenize(text):
+    from nltk.tokenize import word_tokenize as nltk_word_tokenize
+    return nltk_word_tokenize(text)
+
+
+def ngrams(words, n):
+    from nltk import ngrams as nltk_ngrams
+    return nltk_ngrams(words, n)
+
+@timed()
 def get_frequent_words(text, top_n=10):
     words = word_tokenize(text)
     word_counts = Counter(words)
     return word_counts.most_common(top_n)
 
+@timed()
 def get_frequent_ngrams(text, n=2, top_n=10):
     words = word_tokenize(text)
     n_grams = ngrams(words, n)
     n_gram_counts = Counter(n_grams)
     return n_gram_counts.most_common(top_n)
 
+@timed()
 def get_tfidf_scores(documents):
+    from sklearn.feature_extraction.text import TfidfVectorizer
     vectorizer = TfidfVectorizer()
     tfidf_matrix = vectorizer.fit_transform(documents)
     feature_names = vectorizer.get_feature_names_out()
+    # Slice the CSR arrays directly instead of materializing one sparse row per document
+    indptr, indices, data = tfidf_matrix.indptr, tfidf_matrix.indices, tfidf_matrix.data
     tfidf_scores = []
-    for doc_idx, doc in enumerate(tfidf_matrix):
-        scores = {feature_names[word_idx]: score for word_idx, score in zip(doc.indices, doc.data)}
+    for start, end in zip(indptr[:-1], indptr[1:]):
+        scores = dict(zip(feature_names[indices[start:end]].tolist(), data[start:end].tolist()))
         tfidf_scores.append(scores)
     return tfidf_scores
+
+
+def _rank_key(item):
+    return -item[1], item[0]
+
+
+# Highest counts first, ties broken by the item itself so the ranking does not depend
+# on insertion order (and therefore not on how the corpus was split across workers).
+def most_common(counts, n=None):
+    if n is None:
+        return sorted(counts.items(), key=_rank_key)
+    return heapq.nsmallest(n, counts.items(), key=_rank_key)
+
+
+# Space-saving top-k counter: keeps at most 2 * capacity entries. Counts of items that
+# were evicted and later seen again are overestimated by at most `error`.
+class SpaceSavingCounter:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def update(self, items):
+        if not isinstance(items, (Counter, dict)):
+            items = Counter(items)
+        counts = self.counts
+        for item, count in items.items():
+            if item in counts:
+                counts[item] += count
+            else:
+                counts[item] = self.error + count
+        if len(counts) > 2 * self.capacity:
+            self._prune()
+
+    def items(self):
+        return self.counts.items()
+
+    def _prune(self):
+        kept = most_common(self.counts, self.capacity + 1)
+        self.error = max(self.error, kept[-1][1])
+        self.counts = dict(kept[:self.capacity])
+
+    def most_common(self, n=None):
+        return most_common(self.counts, n)
+
+    def __len__(self):
+        return len(self.counts)
+
+
+# Word and n-gram counts built from a stream of texts, tokenizing each text once.
+# With max_items set, both tables are bounded space-saving counters instead of
+# exact Counters, so memory stays constant however long the history is.
+class CorpusStatistics:
+    def __init__(self, n=2, max_items=None):
+        self.n = n
+        self.max_items = max_items
+        if max_items is None:
+            self.word_counts = Counter()
+            self.ngram_counts = Counter()
+        else:
+            self.word_counts = SpaceSavingCounter(max_items)
+            self.ngram_counts = SpaceSavingCounter(max_items)
+        self.documents = 0
+        self.tokens = 0
+
+    def update(self, text):
+        words = word_tokenize(text)
+        self.word_counts.update(words)
+        self.ngram_counts.update(ngrams(words, self.n))
+        self.documents += 1
+        self.tokens += len(words)
+        return self
+
+    def update_many(self, texts):
+        for text in texts:
+            self.update(text)
+        return self
+
+    def merge(self, word_counts, ngram_counts, documents=0, tokens=0):
+        self.word_counts.update(word_counts)
+        self.ngram_counts.update(ngram_counts)
+        self.documents += documents
+        self.tokens += tokens
+        return self
+
+    def most_common_words(self, top_n=10):
+        return most_common(self.word_counts, top_n)
+
+    def most_common_ngrams(self, top_n=10):
+        return most_common(self.ngram_counts, top_n)
+
+
+def _count_chunk(texts, n):
+    stats = CorpusStatistics(n=n).update_many(texts)
+    return stats.word_counts, stats.ngram_counts, stats.documents, stats.tokens
+
+
+def _chunks(texts, chunk_size):
+    texts = iter(texts)
+    while True:
+        chunk = list(islice(texts, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Builds CorpusStatistics across a process pool (workers=None uses every core). Each worker counts one chunk of texts
+# (e.g. one chat session) into exact Counters and the parent merges them in submission
+# order. At most 2 * workers chunks are in flight, so the input can be a lazy stream.
+@timed()
+def build_corpus_statistics(texts, n=2, max_items=None, workers=1, chunk_size=256):
+    stats = CorpusStatistics(n=n, max_items=max_items)
+    if workers == 1:
+        return stats.update_many(texts)
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_pending = 2 * workers
+        pending = deque()
+        for chunk in _chunks(texts, chunk_size):
+            pending.append(executor.submit(_count_chunk, chunk, n))
+            if len(pending) >= max_pending:
+                stats.merge(*pending.popleft().result())
+        while pending:
+            stats.merge(*pending.popleft().result())
+    return stats
+
+
+WHITESPACE_PATTERN = re.compile(r"(\s+)")
+
+
+@timed()
+def count_phrases(texts, max_n=3, min_count=2):
+    # Counts every run of 1..max_n whitespace-separated tokens that appears in the texts
+    # as the tokens joined by single spaces, i.e. the phrases a dictionary can replace.
+    # Returns [(phrase, count)] for phrases seen at least min_count times. Tokens are
+    # mapped to integer ids once and n-grams are counted as rows of an id matrix.
+    vocabulary = {}
+    ids = []
+    joined = []  # joined[i]: token i and i + 1 are separated by exactly one space
+    for text in texts:
+        parts = WHITESPACE_PATTERN.split(text)
+        tokens, separators = parts[0::2], parts[1::2]
+        if not tokens[0]:
+            tokens, separators = tokens[1:], separators[1:]
+        if tokens and not tokens[-1]:
+            tokens, separators = tokens[:-1], separators[:-1]
+        if not tokens:
+            continue
+        ids.extend([vocabulary.setdefault(token, len(vocabulary)) for token in tokens])
+        joined.extend([separator == " " for separator in separators])
+        joined.append(False)  # phrases never span two texts
+
+    words = list(vocabulary)
+    ids = np.array(ids, dtype=np.int64)
+    joined = np.array(joined, dtype=bool)
+    phrases = []
+    for n in range(1, max_n + 1):
+        rows = len(ids) - n + 1
+        if rows <= 0:
+            break
+        valid = np.ones(rows, dtype=bool)
+        for offset in range(n - 1):
+            valid &= joined[offset:offset + rows]
+        grams = np.stack([ids[offset:offset + rows] for offset in range(n)], axis=1)[valid]
+        if not len(grams):
+            continue
+        unique, counts = np.unique(grams, axis=0, return_counts=True)
+        frequent = counts >= min_count
+        for gram, count in zip(unique[frequent].tolist(), counts[frequent].tolist()):
+            phrases.append((" ".join(words[token] for token in gram), count))
+    return phrases
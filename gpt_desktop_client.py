@@ -1,22 +1,33 @@
 import os
-import re
 import sqlite3
+import sys
+import threading
+import time
 import uuid
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QCoreApplication, Qt, QThreadPool, QTimer
 from PyQt5.QtGui import QFont, QIcon
-from PyQt5.QtWebEngineWidgets import QWebEngineView
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QTextEdit, QPushButton, QMessageBox, \
-    QSplitter, QHBoxLayout, QComboBox, QTabWidget, QLineEdit, QLabel, QFormLayout, QFontComboBox, QSpinBox, QScrollArea, \
-    QFrame, QListWidget, QListWidgetItem, QMenu, QInputDialog
-from bs4 import BeautifulSoup
-from cryptography.fernet import Fernet, InvalidToken
+    QSplitter, QHBoxLayout, QComboBox, QTabWidget, QLineEdit, QLabel, QFormLayout, QFontComboBox, QSpinBox, \
+    QListView, QMenu, QInputDialog, QCheckBox, QFileDialog, QTableWidget, QTableWidgetItem, QAbstractItemView
 from dotenv import load_dotenv
-from markdown import markdown
-from markdown.extensions.codehilite import CodeHiliteExtension
-from markdown.extensions.fenced_code import FencedCodeExtension
-from openai import OpenAI
-from pygments.formatters.html import HtmlFormatter
+
+import api_client
+import chat_archive
+import context_window
+import instrumentation
+import response_cache
+import storage
+import tokenizer
+from chat_list import ChatListModel
+from context_window import build_context
+from rendering import forget_rendered, prune_render_cache, render_markdown, render_markdown_many, render_prompt
+from request_worker import BackgroundTask, CompletionRequest, RequestScheduler
+from storage import initialize_database, save_encrypted_api_key, load_encrypted_api_key, save_font_settings, \
+    load_font_settings, update_chat_name, delete_chat_session, load_chat_context, load_chat_history, \
+    load_chat_history_page, load_chat_history_after, search_messages, search_sessions, get_tfidf_index, \
+    save_tfidf_index, save_token_counts, save_context_budget, load_context_budgets, save_response_cache_enabled, \
+    load_response_cache_enabled
 
 # Determine the user's profile directory
 app_data_dir = os.path.join(os.getenv('APPDATA'), 'GPTDesktopClient')
@@ -29,6 +40,7 @@ db_path = os.path.join(app_data_dir, "settings.db")
 
 
 def load_or_generate_key():
+    from cryptography.fernet import Fernet
     if os.path.exists(KEY_FILE):
         with open(KEY_FILE, "rb") as key_file:
             key = key_file.read()
@@ -39,147 +51,84 @@ def load_or_generate_key():
     return key
 
 
-encryption_key = load_or_generate_key()
-cipher_suite = Fernet(encryption_key)
-
-# Database setup
-
-
-def initialize_database():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            id INTEGER PRIMARY KEY,
-            theme TEXT,
-            font_name TEXT,
-            font_size INTEGER
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id INTEGER PRIMARY KEY,
-            api_key TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_sessions (
-            session_id TEXT PRIMARY KEY,
-            chat_name TEXT
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
-            message_role TEXT,
-            message_content TEXT,
-            model TEXT,
-            FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id)
-        )
-    """)
-    conn.commit()
-    conn.close()
+cipher_suite = None  # created when the API key is first saved or read
+_key_lock = threading.Lock()  # the key is also decrypted by the startup warm-up thread
+
+
+def get_cipher_suite():
+    global cipher_suite
+    if cipher_suite is None:
+        from cryptography.fernet import Fernet
+        cipher_suite = Fernet(load_or_generate_key())
+    return cipher_suite
+
+
+storage.configure(db_path)
+
+HISTORY_PAGE_SIZE = 20  # messages rendered when a chat is opened and per page while scrolling
+MAX_LIVE_MESSAGES = 60  # messages kept in the chat view; pages scrolled far out of view are dropped
+COMPACTION_DELAY_MS = 30000  # pending message recompression starts this long after startup
+TFIDF_INDEX_DELAY_MS = 10000  # the TF-IDF index is loaded (and caught up) this long after startup
+TIMINGS_REFRESH_MS = 2000  # diagnostics table (and timings file) update interval
+
+
+cached_api_key = None  # decrypted key, so it is read and decrypted once
 
 
 def save_api_key(api_key):
-    encrypted_api_key = cipher_suite.encrypt(api_key.encode())
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO api_keys (id, api_key) VALUES (1, ?)", (encrypted_api_key,))
-    conn.commit()
-    conn.close()
+    global cached_api_key
+    with _key_lock:
+        encrypted_api_key = get_cipher_suite().encrypt(api_key.encode())
+        save_encrypted_api_key(encrypted_api_key)
+        cached_api_key = api_key
+
+
+def decrypt_api_key():
+    # "" if no key is stored, None if it can't be decrypted; safe to call off the GUI thread
+    global cached_api_key
+    from cryptography.fernet import InvalidToken
+    with _key_lock:
+        if cached_api_key is None:
+            encrypted_api_key = load_encrypted_api_key()
+            if not encrypted_api_key:
+                return ""
+            try:
+                cached_api_key = get_cipher_suite().decrypt(encrypted_api_key).decode()
+            except InvalidToken:
+                return None
+        return cached_api_key
 
 
 def load_api_key():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT api_key FROM api_keys WHERE id = 1")
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        try:
-            decrypted_api_key = cipher_suite.decrypt(result[0]).decode()
-            return decrypted_api_key
-        except InvalidToken:
-            QMessageBox.warning(None, "Invalid Token",
-                                "The stored API key could not be decrypted. Please re-enter your API key.")
-            return ""
-    return ""
-
-
-def save_font_settings(font_name, font_size):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO settings (id, font_name, font_size) VALUES (1, ?, ?)",
-                   (font_name, font_size))
-    conn.commit()
-    conn.close()
-
-
-def load_font_settings():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT font_name, font_size FROM settings WHERE id = 1")
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0], result[1]
-    return "Arial", 12  # default font settings if none are saved
-
-
-def create_chat_session(session_id, chat_name):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO chat_sessions (session_id, chat_name) VALUES (?, ?)",
-                   (session_id, chat_name))
-    conn.commit()
-    conn.close()
-
-
-def update_chat_name(session_id, new_name):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE chat_sessions SET chat_name = ? WHERE session_id = ?", (new_name, session_id))
-    conn.commit()
-    conn.close()
-
-
-def delete_chat_session(session_id):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM chats WHERE session_id = ?", (session_id,))
-    cursor.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
-    conn.commit()
-    conn.close()
-
-
-def save_chat_history(session_id, role, content, model):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO chats (session_id, message_role, message_content, model) VALUES (?, ?, ?, ?)",
-                   (session_id, role, content, model))
-    conn.commit()
-    conn.close()
-
-
-def load_chat_sessions():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT session_id, chat_name FROM chat_sessions")
-    sessions = cursor.fetchall()
-    conn.close()
-    return sessions
-
-
-def load_chat_history(session_id):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT message_role, message_content, model FROM chats WHERE session_id = ? ORDER BY id",
-                   (session_id,))
-    chats = cursor.fetchall()
-    conn.close()
-    return chats
+    api_key = decrypt_api_key()
+    if api_key is None:
+        QMessageBox.warning(None, "Invalid Token",
+                            "The stored API key could not be decrypted. Please re-enter your API key.")
+        return ""
+    return api_key
+
+
+def warm_up():
+    # Runs on a pool thread once the window is shown: loads what the first render and the
+    # first request need (markdown, Pygments, the OpenAI SDK, the tokenizer) and decrypts
+    # the API key, so none of it delays startup or the first message
+    render_markdown("```python\nprint()\n```")
+    prune_render_cache()
+    import openai  # noqa: F401
+    tokenizer.get_encoding()
+    return decrypt_api_key()
+
+
+def compact_messages(enable, stop):
+    # Runs on a pool thread; compression (and its dependencies) load only when used
+    import message_compression
+    if enable:
+        message_compression.enable()
+    elif enable is not None:
+        message_compression.disable()
+    elif not message_compression.pending_messages():
+        return 0
+    return message_compression.compact(should_stop=stop.is_set)
 
 
 class MainWindow(QMainWindow):
@@ -202,10 +151,26 @@ class MainWindow(QMainWindow):
 
         self.session_id = None
         self.chat_name = None
+        # Requests run on a thread pool; chats can have requests in flight at the same time
+        self.request_scheduler = RequestScheduler(self.send_gpt_request, self.prepare_request, parent=self)
+        self.request_scheduler.started.connect(self.on_request_started)
+        self.request_scheduler.progress.connect(self.on_request_progress)
+        self.request_scheduler.finished.connect(self.on_request_finished)
+        self.request_scheduler.failed.connect(self.on_request_failed)
+        self.request_scheduler.cancelled.connect(self.on_request_cancelled)
+        self.streaming_request = None  # request whose response is streaming into the chat view
+        self._chat_view = None
+        self.startup_started = False
+        self.warm_up_task = None
+        self.tfidf_task = None
+        self.warmed_up = False
         self.setup_main_tab()
         self.setup_settings_tab()
 
-        self.conversation_history = []  # List to store the chat history
+        self.session_histories = {}  # session_id -> chat history, read when first needed
+        self.loaded_messages = []  # (message id, content) for the messages currently shown
+        self.has_older = False
+        self.has_newer = False
         self.load_chats()
 
     def setup_main_tab(self):
@@ -213,28 +178,45 @@ class MainWindow(QMainWindow):
 
         self.chat_splitter = QSplitter(Qt.Horizontal)
 
-        self.chat_list_widget = QListWidget(self)
-        self.chat_list_widget.itemClicked.connect(self.load_chat)
-        self.chat_list_widget.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.chat_list_widget.customContextMenuRequested.connect(self.show_context_menu)
-        self.chat_splitter.addWidget(self.chat_list_widget)
+        self.sidebar_widget = QWidget()
+        self.sidebar_layout = QVBoxLayout(self.sidebar_widget)
+        self.sidebar_layout.setContentsMargins(0, 0, 0, 0)
+
+        # Full-text search over all chats; runs shortly after the user stops typing
+        self.search_entry = QLineEdit(self)
+        self.search_entry.setPlaceholderText("Search chats")
+        self.search_entry.setClearButtonEnabled(True)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.search_chats)
+        self.search_entry.textChanged.connect(self.search_timer.start)
+        self.search_hits = {}  # session_id -> best matching message id (None: no match)
+        self.sidebar_layout.addWidget(self.search_entry)
+
+        # Sessions are read from the database a page at a time as the list is scrolled
+        self.chat_list_model = ChatListModel(self)
+        self.chat_list_view = QListView(self)
+        self.chat_list_view.setUniformItemSizes(True)
+        self.chat_list_view.setModel(self.chat_list_model)
+        self.chat_list_view.clicked.connect(self.load_chat)
+        self.chat_list_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.chat_list_view.customContextMenuRequested.connect(self.show_context_menu)
+        self.sidebar_layout.addWidget(self.chat_list_view)
+        self.chat_splitter.addWidget(self.sidebar_widget)
 
         self.chat_area_widget = QWidget()
         self.chat_area_layout = QVBoxLayout(self.chat_area_widget)
 
         self.chat_splitter2 = QSplitter(Qt.Vertical)
 
-        self.history_area = QScrollArea(self)
-        self.history_area.setWidgetResizable(True)
-        self.history_widget = QWidget()
-        self.history_layout = QVBoxLayout(self.history_widget)
-        self.history_widget.setLayout(self.history_layout)
-        self.history_area.setWidget(self.history_widget)
+        # Stands in for the chat view until QtWebEngine is loaded (see chat_view)
+        self.chat_view_placeholder = QWidget(self)
 
         self.prompt_entry = QTextEdit(self)
         self.prompt_entry.setPlaceholderText("Enter your prompt")
 
-        self.chat_splitter2.addWidget(self.history_area)
+        self.chat_splitter2.addWidget(self.chat_view_placeholder)
         self.chat_splitter2.addWidget(self.prompt_entry)
         self.chat_splitter2.setSizes([400, 100])
 
@@ -250,6 +232,10 @@ class MainWindow(QMainWindow):
         self.fetch_button = QPushButton("Submit", self)
         self.fetch_button.clicked.connect(self.fetch_and_display)
 
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_requests)
+        self.cancel_button.setEnabled(False)
+
         self.new_chat_button = QPushButton("New Chat", self)
         self.new_chat_button.clicked.connect(self.new_chat)
 
@@ -257,6 +243,7 @@ class MainWindow(QMainWindow):
         self.copy_all_button.clicked.connect(self.copy_all_content)
 
         self.controls_layout.addWidget(self.fetch_button)
+        self.controls_layout.addWidget(self.cancel_button)
         self.controls_layout.addWidget(self.new_chat_button)
         self.controls_layout.addWidget(self.copy_all_button)
         self.controls_layout.addStretch()
@@ -276,10 +263,7 @@ class MainWindow(QMainWindow):
         self.settings_layout = QFormLayout(self.settings_widget)
 
         self.api_key_input = QLineEdit(self)
-        self.api_key_input.setPlaceholderText("Enter your OpenAI API Key")
-        saved_api_key = load_api_key()
-        if saved_api_key:
-            self.api_key_input.setText(saved_api_key)
+        self.api_key_input.setPlaceholderText("Enter your OpenAI API Key")  # filled in by the warm-up
 
         self.save_api_key_button = QPushButton("Save API Key", self)
         self.save_api_key_button.clicked.connect(self.save_api_key)
@@ -295,14 +279,127 @@ class MainWindow(QMainWindow):
         self.save_font_settings_button = QPushButton("Save Font Settings", self)
         self.save_font_settings_button.clicked.connect(self.save_font_settings)
 
+        # Token budget of the requests sent with the model selected in the main tab
+        context_window.budgets.update(load_context_budgets())
+        self.context_budget_spin_box = QSpinBox(self)
+        self.context_budget_spin_box.setRange(0, 1000000)
+        self.context_budget_spin_box.setSingleStep(1000)
+        self.context_budget_spin_box.setSpecialValueText("Model default")
+        self.model_selector.currentTextChanged.connect(self.show_context_budget)
+        self.show_context_budget(self.model_selector.currentText())
+
+        self.save_context_budget_button = QPushButton("Save Context Budget", self)
+        self.save_context_budget_button.clicked.connect(self.save_context_budget)
+
+        # Identical requests (same model and messages) can be answered from a local cache
+        response_cache.enabled = load_response_cache_enabled()
+        self.response_cache_check_box = QCheckBox("Answer repeated requests from the local cache", self)
+        self.response_cache_check_box.setChecked(response_cache.enabled)
+        self.response_cache_check_box.toggled.connect(self.set_response_cache_enabled)
+        self.response_cache_stats_label = QLabel(self)
+        self.update_response_cache_stats()
+        self.clear_response_cache_button = QPushButton("Clear Response Cache", self)
+        self.clear_response_cache_button.clicked.connect(self.clear_response_cache)
+
+        # Message bodies can be stored compressed with a dictionary trained on the history;
+        # existing messages are rewritten in the background
+        self.message_compression_check_box = QCheckBox("Compress stored messages", self)
+        self.message_compression_check_box.setChecked(storage.message_compression is not None)
+        self.message_compression_check_box.toggled.connect(self.set_message_compression_enabled)
+        self.compaction_task = None
+        self.compaction_stop = threading.Event()
+        if storage.message_compression is not None:
+            QTimer.singleShot(COMPACTION_DELAY_MS, lambda: self.start_compaction(None))
+
+        # All chats to or from a JSON Lines file (gzip compressed if it ends in .gz)
+        self.export_chats_button = QPushButton("Export Chats...", self)
+        self.export_chats_button.clicked.connect(self.export_chats)
+        self.import_chats_button = QPushButton("Import Chats...", self)
+        self.import_chats_button.clicked.connect(self.import_chats)
+        self.archive_task = None
+
+        # Stage timings (queueing, request, rendering, saving, ...) for finding slow spots
+        self.timings_check_box = QCheckBox("Record stage timings", self)
+        self.timings_check_box.setChecked(instrumentation.enabled)
+        self.timings_check_box.toggled.connect(self.set_timings_enabled)
+        self.timings_table = QTableWidget(0, 5, self)
+        self.timings_table.setHorizontalHeaderLabels(["Stage", "Count", "p50 (ms)", "p95 (ms)", "Max (ms)"])
+        self.timings_table.verticalHeader().setVisible(False)
+        self.timings_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.export_timings_button = QPushButton("Export Timings...", self)
+        self.export_timings_button.clicked.connect(self.export_timings)
+        self.reset_timings_button = QPushButton("Reset Timings", self)
+        self.reset_timings_button.clicked.connect(self.reset_timings)
+        self.timings_file = None  # rewritten on every refresh when set (GPT_DESKTOP_TIMINGS_FILE)
+        self.timings_timer = QTimer(self)
+        self.timings_timer.setInterval(TIMINGS_REFRESH_MS)
+        self.timings_timer.timeout.connect(self.refresh_timings)
+        if instrumentation.enabled:
+            self.timings_timer.start()
+
         self.settings_layout.addRow(QLabel("OpenAI API Key:"), self.api_key_input)
         self.settings_layout.addWidget(self.save_api_key_button)
         self.settings_layout.addRow(QLabel("Font:"), self.font_combo_box)
         self.settings_layout.addRow(QLabel("Font Size:"), self.font_size_spin_box)
         self.settings_layout.addWidget(self.save_font_settings_button)
+        self.settings_layout.addRow(QLabel("Context Budget (tokens):"), self.context_budget_spin_box)
+        self.settings_layout.addWidget(self.save_context_budget_button)
+        self.settings_layout.addRow(QLabel("Response Cache:"), self.response_cache_check_box)
+        self.settings_layout.addRow(self.response_cache_stats_label, self.clear_response_cache_button)
+        self.settings_layout.addRow(QLabel("Message Storage:"), self.message_compression_check_box)
+        self.settings_layout.addRow(self.export_chats_button, self.import_chats_button)
+        self.settings_layout.addRow(QLabel("Diagnostics:"), self.timings_check_box)
+        self.settings_layout.addRow(self.timings_table)
+        self.settings_layout.addRow(self.export_timings_button, self.reset_timings_button)
+
+    @property
+    def chat_view(self):
+        # QtWebEngine is the slowest part of startup, so the view is created after the
+        # window is first painted (or as soon as anything needs it)
+        if self._chat_view is None:
+            from chat_view import ChatView
+            self._chat_view = ChatView(self)
+            self._chat_view.scrolled_to_top.connect(self.load_older_messages)
+            self._chat_view.scrolled_to_bottom.connect(self.load_newer_messages)
+            self._chat_view.copy_requested.connect(self.copy_message)
+            self.chat_splitter2.replaceWidget(0, self._chat_view)
+            self.chat_view_placeholder.deleteLater()
+        return self._chat_view
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.startup_started:
+            # The first frame is on screen; load the rest without holding it up
+            self.startup_started = True
+            QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        self.chat_view
+        self.warm_up_task = BackgroundTask(warm_up)
+        self.warm_up_task.signals.finished.connect(self.on_warm_up_finished)
+        self.warm_up_task.signals.failed.connect(self.on_warm_up_failed)
+        QThreadPool.globalInstance().start(self.warm_up_task)
+        QTimer.singleShot(TFIDF_INDEX_DELAY_MS, self.load_tfidf_index)
+
+    def load_tfidf_index(self):
+        # From then on it follows saved and deleted messages, and it is saved on exit
+        self.tfidf_task = BackgroundTask(get_tfidf_index)
+        self.tfidf_task.signals.failed.connect(
+            lambda error: self.statusBar().showMessage(f"Could not load the TF-IDF index: {error}"))
+        QThreadPool.globalInstance().start(self.tfidf_task)
+
+    def on_warm_up_finished(self, api_key):
+        if api_key and not self.api_key_input.text():
+            self.api_key_input.setText(api_key)
+        self.warmed_up = True
+
+    def on_warm_up_failed(self, error):
+        # Whatever failed to load is loaded (and reported) again when it is used
+        self.warmed_up = True
 
     def fetch_and_display(self):
-        openai_api_key = load_api_key()
+        with instrumentation.span("submit.api_key"):
+            openai_api_key = load_api_key()
 
         if not openai_api_key:
             QMessageBox.critical(self, "Error", "OpenAI API Key not set. Please enter it in the settings tab.")
@@ -314,195 +411,117 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Input Error", "Please enter a prompt.")
             return
 
-        model = self.model_selector.currentText()
-
-        try:
-            # Create the chat messages list, starting with the conversation history
-            chat_messages = [{"role": message["role"], "content": message["content"]} for message in
-                             self.conversation_history]
-
-            # Add the new user prompt to the chat messages
-            chat_messages.append({"role": "user", "content": user_prompt})
+        if self.session_id is None:
+            # The session row is written together with the first exchange
+            self.session_id = str(uuid.uuid4())
+            self.chat_name = user_prompt[:60]
 
-            completion = self.send_gpt_request(openai_api_key, model, chat_messages)
-            response = completion.choices[0].message.content
+        request = CompletionRequest(self.session_id, self.chat_name, self.model_selector.currentText(), user_prompt,
+                                    openai_api_key, use_cache=response_cache.enabled)
+        self.prompt_entry.clear()
+        self.request_scheduler.submit(request)
+        self.update_request_controls()
+
+    def prepare_request(self, request):
+        # Runs right before the request starts, after earlier requests of its chat finished.
+        # Old turns that don't fit in the model's token budget are summarized or dropped.
+        history = self.get_conversation_history(request.session_id)
+        uncounted = [message for message in history if message["tokens"] is None]
+        with instrumentation.span("submit.build_context"):
+            request.messages, request.context_report = build_context(history, request.user_prompt, request.model)
+        if uncounted:
+            try:
+                save_token_counts([(message["id"], message["tokens"]) for message in uncounted])
+            except sqlite3.OperationalError:
+                pass  # counted again next time
+
+    def on_request_started(self, request):
+        if request.session_id != self.session_id:
+            return
+        if self.has_newer:
+            # The end of the chat is not loaded; jump back to it before streaming
+            self.show_chat_page()
+        with instrumentation.span("ui.start_stream"):
+            self.chat_view.start_stream(render_prompt(request.user_prompt))
+        self.streaming_request = request
+        report = request.context_report
+        message = f"Sent {report['sent_tokens']} tokens"
+        if report["dropped_messages"]:
+            message += (f", {report['dropped_messages']} older messages "
+                        f"{'summarized' if report['summarized'] else 'dropped'} ({report['saved_tokens']} tokens saved)")
+        self.statusBar().showMessage(message)
+
+    def on_request_progress(self, request, finished_html, tail_html):
+        if request is self.streaming_request:
+            self.chat_view.update_stream(finished_html, tail_html)
+
+    def on_request_finished(self, request, result):
+        started = time.perf_counter()
+        response = result["response"]
+        message_ids = result["message_ids"]
+        history = self.session_histories.get(request.session_id)
+        if history is not None:
+            for message_id, role, content, tokens in zip(message_ids, ("user", "assistant"),
+                                                         (request.user_prompt, response), result["token_counts"]):
+                history.append({"id": message_id, "role": role, "content": content, "tokens": tokens})
+
+        if request is self.streaming_request:
+            # Replace the streamed blocks with the complete message
+            self.streaming_request = None
             self.raw_markdown = response
-
-            codehilite = CodeHiliteExtension(linenums=False, css_class='codehilite')
-            fenced_code = FencedCodeExtension()
-            html_content = markdown(response, extensions=[codehilite, fenced_code])
-
-            html_content = self.add_code_headers_and_copy_buttons(html_content, response)
-
-            # Generate session ID and chat name if not provided
-            if self.session_id is None:
-                self.session_id = str(uuid.uuid4())
-                create_chat_session(self.session_id, user_prompt[:60])
-            if self.chat_name is None:
-                self.chat_name = user_prompt[:60]
-
-            # Update the conversation history
-            self.conversation_history.append({"role": "user", "content": user_prompt})
-            self.conversation_history.append({"role": "assistant", "content": response})
-
-            # Save chat history
-            save_chat_history(self.session_id, "user", user_prompt, model)
-            save_chat_history(self.session_id, "assistant", response, model)
-
-            # Display the chat history
-            self.display_chat_history(user_prompt, response, html_content)
-
-            # Clear the current prompt entry
-            self.prompt_entry.clear()
-
-            # Add the new chat to the chat list
-            if not any(item.text() == self.chat_name for item in
-                       self.chat_list_widget.findItems(self.chat_name, Qt.MatchExactly)):
-                item = QListWidgetItem(self.chat_name)
-                item.setData(Qt.UserRole, self.session_id)
-                self.chat_list_widget.addItem(item)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"An error occurred: {e}")
-
-    def send_gpt_request(self, api_key, model, prompt):
-        # Set up the OpenAI client with the provided API key
-        client = OpenAI()
-        client.api_key = api_key
-
-        # Prepare and send the request to OpenAI
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": f"{prompt}: "}],
-            stream=False  # Stream responses to process them as they arrive
-        )
-
-        return completion
-
-    def extract_languages_from_markdown(self, markdown_content):
-        pattern = re.compile(r'```(\w+)?')
-        matches = pattern.findall(markdown_content)
-        languages = ['plaintext' if not lang else lang for lang in matches]
-        return languages
-
-    def add_code_headers_and_copy_buttons(self, html_content, markdown_content):
-        languages = self.extract_languages_from_markdown(markdown_content)
-
-        style = "monokai"
-        background_color = "#2E2E2E"
-        text_color = "#d8dee9"
-
-        full_html_content = f"""
-        <html>
-        <head>
-            <style>
-                {HtmlFormatter(style=style).get_style_defs('.codehilite')}
-                .code-block-container {{
-                    position: relative;
-                    margin-bottom: 20px;
-                    border: 1px solid #e1e4e8;
-                    border-radius: 6px;
-                    overflow: hidden;
-                }}
-                .code-header {{
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                    background: {background_color};
-                    padding: 8px;
-                    font-size: 12px;
-                    font-family: Arial, sans-serif;
-                    color: {text_color};
-                    border-bottom: 1px solid #e1e4e8;
-                }}
-                .code-header .language {{
-                    font-weight: bold;
-                }}
-                .code-header button.copy-button {{
-                    background: none;
-                    border: none;
-                    color: #0366d6;
-                    cursor: pointer;
-                    font-size: 12px;
-                }}
-                pre {{
-                    background: {background_color};
-                    color: {text_color};
-                    border-radius: 0 0 6px 6px;
-                    padding: 10px;
-                    overflow-x: auto;
-                    overflow-y: visible;
-                    white-space: pre;
-                    margin: 0;
-                }}
-            </style>
-        </head>
-        <body>
-            {html_content}
-            <script>
-            function copyToClipboard(button) {{
-                var codeBlock = button.parentNode.nextSibling;
-                var text = codeBlock.innerText || codeBlock.textContent;
-                var tempTextArea = document.createElement("textarea");
-                tempTextArea.value = text;
-                document.body.appendChild(tempTextArea);
-                tempTextArea.select();
-                document.execCommand("copy");
-                document.body.removeChild(tempTextArea);
-                button.innerText = "Copied";
-                setTimeout(function() {{
-                    button.innerText = "Copy";
-                }}, 10000);
-            }}
-            </script>
-        </body>
-        </html>
-        """
-
-        soup = BeautifulSoup(full_html_content, 'html.parser')
-
-        code_blocks = soup.find_all('div', class_='codehilite')
-        for index, code_block in enumerate(code_blocks):
-            unique_id = str(uuid.uuid4())
-            code_block['id'] = unique_id
-
-            language = languages[index] if index < len(languages) else 'plaintext'
-
-            div = soup.new_tag('div', **{'class': 'code-block-container', 'id': unique_id})
-            code_block.wrap(div)
-
-            header = soup.new_tag('div', **{'class': 'code-header'})
-            language_span = soup.new_tag('span', **{'class': 'language'})
-            language_span.string = language
-            button = soup.new_tag('button', **{'class': 'copy-button', 'onclick': f'copyToClipboard(this)'})
-            button.string = "Copy"
-
-            header.insert(0, language_span)
-            header.insert(1, button)
-
-            div.insert(0, header)
-
-        return str(soup)
-
-    def display_chat_history(self, user_prompt, response_text, html_response):
-        prompt_label = QLabel(f"Prompt: {user_prompt}")
-        prompt_label.setWordWrap(True)
-
-        response_view = QWebEngineView()
-        response_view.setHtml(html_response)
-
-        copy_response_button = QPushButton("Copy Response")
-        copy_response_button.clicked.connect(lambda: self.copy_to_clipboard(response_text))
-
-        prompt_frame = QFrame()
-        prompt_layout = QVBoxLayout(prompt_frame)
-        prompt_layout.addWidget(prompt_label)
-        prompt_layout.addWidget(copy_response_button)
-        prompt_layout.addWidget(response_view)
-        prompt_frame.setFrameShape(QFrame.Box)
-        prompt_frame.setFrameShadow(QFrame.Raised)
-
-        self.history_layout.addWidget(prompt_frame)
-        self.history_area.verticalScrollBar().setValue(self.history_area.verticalScrollBar().maximum())
+            self.chat_view.finish_stream(message_ids, result["html"], result["cached"])
+            self.loaded_messages.extend(zip(message_ids, (request.user_prompt, response)))
+            self.trim_messages(from_top=True)
+        elif request.session_id == self.session_id and not self.has_newer and \
+                (not self.loaded_messages or self.loaded_messages[-1][0] < message_ids[0]):
+            # The chat was reopened while the request ran; add the exchange at the end
+            self.chat_view.append_messages([{"id": message_ids[0], "role": "user",
+                                             "html": render_prompt(request.user_prompt)},
+                                            {"id": message_ids[1], "role": "assistant", "html": result["html"],
+                                             "cached": result["cached"]}])
+            self.loaded_messages.extend(zip(message_ids, (request.user_prompt, response)))
+            self.trim_messages(from_top=True)
+
+        if request.use_cache:
+            self.update_response_cache_stats()
+            if result["cached"] and request.session_id == self.session_id:
+                self.statusBar().showMessage("Answered from the local response cache")
+
+        # New chats are added to the chat list, and chats with a new message move to the top
+        self.chat_list_model.touch(request.session_id, request.chat_name)
+        self.update_request_controls()
+        instrumentation.record("ui.finish", time.perf_counter() - started)
+        instrumentation.record("submit.total", time.perf_counter() - request.submitted_at)
+
+    def on_request_failed(self, request, error):
+        self.on_request_cancelled(request)
+        QMessageBox.critical(self, "Error", f"An error occurred: {error}")
+
+    def on_request_cancelled(self, request):
+        if request is self.streaming_request:
+            self.streaming_request = None
+            self.chat_view.cancel_stream()
+        # Give the prompt back so it can be edited and sent again
+        if request.session_id == self.session_id and not self.prompt_entry.toPlainText():
+            self.prompt_entry.setPlainText(request.user_prompt)
+        self.update_request_controls()
+
+    def cancel_requests(self):
+        self.request_scheduler.cancel(self.session_id)
+
+    def update_request_controls(self):
+        self.cancel_button.setEnabled(self.request_scheduler.in_flight(self.session_id))
+
+    def send_gpt_request(self, api_key, model, messages, cancel_event):
+        # Stream responses to process them as they arrive; the client for the key is
+        # shared by all requests and retries rate limits and server errors until cancelled
+        return api_client.stream_chat_completion(api_key, model, messages, cancel_event)
+
+    def copy_message(self, message_id):
+        for loaded_id, content in self.loaded_messages:
+            if loaded_id == message_id:
+                self.copy_to_clipboard(content)
+                return
 
     def copy_to_clipboard(self, text):
         clipboard = QApplication.clipboard()
@@ -512,7 +531,7 @@ class MainWindow(QMainWindow):
     def copy_all_content(self):
         clipboard = QApplication.clipboard()
         full_history = ""
-        for item in self.conversation_history:
+        for item in self.get_conversation_history():
             full_history += item["content"] + "\n\n"
         clipboard.setText(full_history)
         QMessageBox.information(self, "Copied", "The entire content has been copied to the clipboard.")
@@ -533,57 +552,279 @@ class MainWindow(QMainWindow):
         self.prompt_entry.setFontPointSize(font_size)
         QMessageBox.information(self, "Saved", "Font settings have been saved.")
 
+    def show_context_budget(self, model):
+        self.context_budget_spin_box.setValue(context_window.budgets.get(model) or 0)
+
+    def save_context_budget(self):
+        model = self.model_selector.currentText()
+        budget = self.context_budget_spin_box.value() or None
+        save_context_budget(model, budget)
+        context_window.budgets[model] = budget
+        QMessageBox.information(self, "Saved", f"Context budget for {model} has been saved.")
+
+    def set_response_cache_enabled(self, enabled):
+        response_cache.enabled = enabled
+        save_response_cache_enabled(enabled)
+
+    def update_response_cache_stats(self):
+        stats = response_cache.stats
+        self.response_cache_stats_label.setText(f"{stats['hits']} hits, {stats['misses']} misses, "
+                                                f"{stats['bytes_saved'] / 1024:.1f} KB saved")
+
+    def clear_response_cache(self):
+        response_cache.clear()
+        self.update_response_cache_stats()
+        QMessageBox.information(self, "Cleared", "The response cache has been cleared.")
+
+    def set_timings_enabled(self, enabled):
+        instrumentation.enable(enabled)
+        if enabled:
+            self.timings_timer.start()
+        else:
+            self.timings_timer.stop()
+        self.refresh_timings()
+
+    def refresh_timings(self):
+        if self.timings_file:
+            self.export_timings_file(self.timings_file)
+        if self.tabs.currentWidget() is not self.settings_widget:
+            return
+        stages = instrumentation.summary()
+        self.timings_table.setRowCount(len(stages))
+        for row, (name, stage) in enumerate(stages.items()):
+            values = [name, stage["count"], stage["p50_ms"], stage["p95_ms"], stage["max_ms"]]
+            for column, value in enumerate(values):
+                self.timings_table.setItem(row, column, QTableWidgetItem(str(value)))
+        self.timings_table.resizeColumnsToContents()
+
+    def export_timings(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Timings", "timings.json",
+                                              "JSON (*.json);;Prometheus text (*.prom)")
+        if path:
+            try:
+                instrumentation.export(path)
+            except OSError as e:
+                QMessageBox.critical(self, "Error", f"Could not export timings: {e}")
+
+    def export_timings_file(self, path=None):
+        try:
+            instrumentation.export(path or self.timings_file)
+        except OSError as e:
+            self.statusBar().showMessage(f"Could not write timings: {e}")
+
+    def reset_timings(self):
+        instrumentation.reset()
+        self.refresh_timings()
+
+    def set_message_compression_enabled(self, enabled):
+        self.start_compaction(enabled)
+
+    def start_compaction(self, enable):
+        # enable: True/False switches the storage mode first; None only finishes rewriting
+        if self.compaction_task is not None:
+            return
+        self.message_compression_check_box.setEnabled(False)
+        self.compaction_task = BackgroundTask(compact_messages, enable, self.compaction_stop)
+        self.compaction_task.signals.finished.connect(self.on_compaction_finished)
+        self.compaction_task.signals.failed.connect(self.on_compaction_failed)
+        QThreadPool.globalInstance().start(self.compaction_task)
+        if enable is not None:
+            self.statusBar().showMessage("Rewriting stored messages...")
+
+    def on_compaction_finished(self, rewritten):
+        self.compaction_task = None
+        self.message_compression_check_box.setEnabled(True)
+        if rewritten:
+            self.statusBar().showMessage(f"{rewritten} stored messages rewritten")
+
+    def on_compaction_failed(self, error):
+        self.compaction_task = None
+        self.message_compression_check_box.setEnabled(True)
+        self.message_compression_check_box.blockSignals(True)
+        self.message_compression_check_box.setChecked(storage.message_compression is not None)
+        self.message_compression_check_box.blockSignals(False)
+        QMessageBox.critical(self, "Error", f"Could not rewrite stored messages: {error}")
+
+    def export_chats(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Chats", "chats.jsonl.gz",
+                                              "Chat exports (*.jsonl.gz *.jsonl)")
+        if path:
+            self.start_archive_task(chat_archive.export_chats, path)
+
+    def import_chats(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Import Chats", "", "Chat exports (*.jsonl.gz *.jsonl)")
+        if path:
+            self.start_archive_task(chat_archive.import_chats, path)
+
+    def start_archive_task(self, function, path):
+        if self.archive_task is not None:
+            return
+        self.export_chats_button.setEnabled(False)
+        self.import_chats_button.setEnabled(False)
+        self.archive_task = BackgroundTask(function, path, report_progress=True)
+        self.archive_task.signals.progress.connect(self.on_archive_progress)
+        self.archive_task.signals.finished.connect(self.on_archive_finished)
+        self.archive_task.signals.failed.connect(self.on_archive_failed)
+        QThreadPool.globalInstance().start(self.archive_task)
+
+    def on_archive_progress(self, done, total):
+        self.statusBar().showMessage(f"{done}/{total} messages")
+
+    def on_archive_finished(self, result):
+        imported = self.archive_task.function is chat_archive.import_chats
+        self.archive_task = None
+        self.export_chats_button.setEnabled(True)
+        self.import_chats_button.setEnabled(True)
+        if imported:
+            self.chat_list_model.reload()
+            self.statusBar().showMessage(f"{result['sessions']} chats and {result['messages']} messages imported")
+        else:
+            self.statusBar().showMessage(f"{result['sessions']} chats and {result['messages']} messages exported")
+
+    def on_archive_failed(self, error):
+        self.archive_task = None
+        self.export_chats_button.setEnabled(True)
+        self.import_chats_button.setEnabled(True)
+        self.statusBar().clearMessage()
+        QMessageBox.critical(self, "Error", f"Could not transfer chats: {error}")
+
+    def stop_background_tasks(self):
+        self.compaction_stop.set()
+        QThreadPool.globalInstance().waitForDone(5000)
+
     def load_chats(self):
-        sessions = load_chat_sessions()
-        for session_id, chat_name in sessions:
-            item = QListWidgetItem(chat_name)
-            item.setData(Qt.UserRole, session_id)
-            self.chat_list_widget.addItem(item)
-
-    def load_chat(self, item):
-        self.session_id = item.data(Qt.UserRole)
-        self.chat_name = item.text()
+        self.chat_list_model.reload()
+
+    def load_chat(self, index):
+        self.session_id = index.data(Qt.UserRole)
+        self.chat_name = index.data(Qt.DisplayRole)
         self.setWindowTitle(f"GPT Desktop Client - Selected Chat: {self.chat_name}")  # Set the window title
-        while self.history_layout.count():
-            child = self.history_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
-        chats = load_chat_history(self.session_id)
-        self.conversation_history = []
-        model = None
-        for role, content, model_used in chats:
-            self.conversation_history.append({"role": role, "content": content})
-            model = model_used
-            if role == "user":
-                prompt_label = QLabel(f"Prompt: {content}")
-                prompt_label.setWordWrap(True)
-                self.history_layout.addWidget(prompt_label)
-            else:
-                response_view = QWebEngineView()
-                html_content = markdown(content,
-                                        extensions=[CodeHiliteExtension(linenums=False, css_class='codehilite'),
-                                                    FencedCodeExtension()])
-                html_content = self.add_code_headers_and_copy_buttons(html_content, content)
-                response_view.setHtml(html_content)
-                self.history_layout.addWidget(response_view)
-        self.model_selector.setCurrentText(model)
-        self.history_widget.setLayout(self.history_layout)
-        self.history_area.setWidget(self.history_widget)
-        self.history_widget.update()
-        self.history_area.update()
-        # Force scroll to the bottom
-        self.history_area.verticalScrollBar().setValue(self.history_area.verticalScrollBar().maximum())
+        self.release_histories()
+        self.update_request_controls()
+        # Open at the search match if this chat was found by a search, otherwise at the end
+        self.show_chat_page(self.search_hit(self.session_id))
+
+    def get_conversation_history(self, session_id=None):
+        # Only the text is needed to send the next prompt, so it is read when needed
+        session_id = self.session_id if session_id is None else session_id
+        if session_id is None:
+            return []
+        if session_id not in self.session_histories:
+            self.session_histories[session_id] = [
+                {"id": message_id, "role": role, "content": content, "tokens": tokens}
+                for message_id, role, content, tokens in load_chat_context(session_id)]
+        return self.session_histories[session_id]
+
+    def release_histories(self):
+        # Keep the histories of the open chat and of chats with requests in flight
+        for session_id in list(self.session_histories):
+            if session_id != self.session_id and not self.request_scheduler.in_flight(session_id):
+                del self.session_histories[session_id]
+
+    def show_chat_page(self, message_id=None):
+        # Renders the page of the current chat ending at message_id, or the latest page
+        self.clear_history_view()
+        before_id = None if message_id is None else message_id + 1
+        chats = load_chat_history_page(self.session_id, before_id=before_id, limit=HISTORY_PAGE_SIZE)
+        self.has_older = len(chats) == HISTORY_PAGE_SIZE
+        self.has_newer = message_id is not None
+        self.chat_view.append_messages(self.render_messages(chats), scroll_to_end=message_id is None)
+        self.loaded_messages = [(chat_id, content) for chat_id, _, content, _ in chats]
+        if chats:
+            self.model_selector.setCurrentText(chats[-1][3])
+        if message_id is not None:
+            self.chat_view.scroll_to_message(message_id)
+
+    def render_messages(self, chats):
+        responses = iter(render_markdown_many([content for _, role, content, _ in chats if role != "user"]))
+        return [{"id": message_id,
+                 "role": role,
+                 "html": render_prompt(content) if role == "user" else next(responses)}
+                for message_id, role, content, _ in chats]
+
+    def trim_messages(self, from_top):
+        excess = len(self.loaded_messages) - MAX_LIVE_MESSAGES
+        if excess <= 0 or (not from_top and self.streaming_request is not None):
+            # The reply streaming in at the bottom must follow the last loaded message; the
+            # excess is trimmed from the top once it has finished
+            return
+        if from_top:
+            del self.loaded_messages[:excess]
+            self.has_older = True
+        else:
+            del self.loaded_messages[-excess:]
+            self.has_newer = True
+        self.chat_view.remove_messages(excess, from_top)
+
+    def clear_history_view(self):
+        self.chat_view.clear_messages()
+        self.streaming_request = None
+        self.loaded_messages = []
+        self.has_older = False
+        self.has_newer = False
+
+    def load_older_messages(self):
+        if not self.has_older or not self.loaded_messages:
+            return
+        chats = load_chat_history_page(self.session_id, before_id=self.loaded_messages[0][0],
+                                       limit=HISTORY_PAGE_SIZE)
+        self.has_older = len(chats) == HISTORY_PAGE_SIZE
+        if not chats:
+            return
+        self.chat_view.prepend_messages(self.render_messages(chats))
+        self.loaded_messages[:0] = [(chat_id, content) for chat_id, _, content, _ in chats]
+        self.trim_messages(from_top=False)
+
+    def load_newer_messages(self):
+        if not self.has_newer or not self.loaded_messages:
+            return
+        chats = load_chat_history_after(self.session_id, self.loaded_messages[-1][0], limit=HISTORY_PAGE_SIZE)
+        self.has_newer = len(chats) == HISTORY_PAGE_SIZE
+        if not chats:
+            return
+        self.chat_view.append_messages(self.render_messages(chats), scroll_to_end=False)
+        self.loaded_messages.extend((chat_id, content) for chat_id, _, content, _ in chats)
+        self.trim_messages(from_top=True)
+
+    def search_chats(self):
+        text = self.search_entry.text()
+        self.search_hits = {}
+        if text.strip():
+            try:
+                # Every matching chat is listed; the best hits only say where to open them
+                session_ids = search_sessions(text)
+                for message_id, session_id, role, snippet in search_messages(text):
+                    self.search_hits.setdefault(session_id, message_id)
+            except sqlite3.OperationalError:
+                return
+            self.chat_list_model.show_only(session_ids)
+        elif self.chat_list_model.filtered:
+            self.chat_list_model.reload()
+        else:
+            return
+        # Keep the open chat selected if it is listed
+        self.chat_list_view.setCurrentIndex(self.chat_list_model.index_of(self.session_id))
+
+    def search_hit(self, session_id):
+        # Best matching message in the session for the current search, looked up when the
+        # session had none among the overall best hits
+        if not self.chat_list_model.filtered:
+            return None
+        if session_id not in self.search_hits:
+            try:
+                hits = search_messages(self.search_entry.text(), 1, session_id)
+            except sqlite3.OperationalError:
+                hits = []
+            self.search_hits[session_id] = hits[0][0] if hits else None
+        return self.search_hits[session_id]
 
     def new_chat(self):
         self.session_id = None
         self.chat_name = None
-        self.conversation_history = []
-        while self.history_layout.count():
-            child = self.history_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
+        self.release_histories()
+        self.update_request_controls()
+        self.clear_history_view()
         self.prompt_entry.clear()
-        self.history_area.verticalScrollBar().setValue(self.history_area.verticalScrollBar().maximum())
         # Set focus on the prompt entry to start the new chat
         self.prompt_entry.setFocus()
 
@@ -591,7 +832,7 @@ class MainWindow(QMainWindow):
         context_menu = QMenu(self)
         rename_action = context_menu.addAction("Rename Chat")
         delete_action = context_menu.addAction("Delete Chat")  # Add the delete action
-        action = context_menu.exec_(self.chat_list_widget.mapToGlobal(pos))
+        action = context_menu.exec_(self.chat_list_view.mapToGlobal(pos))
 
         if action == rename_action:
             self.rename_chat()
@@ -599,39 +840,74 @@ class MainWindow(QMainWindow):
             self.delete_chat()
 
     def rename_chat(self):
-        item = self.chat_list_widget.currentItem()
-        if item:
+        index = self.chat_list_view.currentIndex()
+        if index.isValid():
             new_name, ok = QInputDialog.getText(self, "Rename Chat", "Enter new chat name:")
             if ok and new_name:
-                session_id = item.data(Qt.UserRole)
-                update_chat_name(session_id, new_name)
-                item.setText(new_name)
+                session_id = index.data(Qt.UserRole)
+                try:
+                    update_chat_name(session_id, new_name)
+                except sqlite3.OperationalError as e:
+                    QMessageBox.critical(self, "Error", f"Could not rename the chat: {e}")
+                    return
+                self.chat_list_model.rename(session_id, new_name)
                 if self.session_id == session_id:
                     self.chat_name = new_name
                     self.setWindowTitle(f"GPT Desktop Client - Selected Chat: {self.chat_name}")
 
     def delete_chat(self):
-        item = self.chat_list_widget.currentItem()
-        if item:
-            session_id = item.data(Qt.UserRole)
+        index = self.chat_list_view.currentIndex()
+        if index.isValid():
+            session_id = index.data(Qt.UserRole)
             reply = QMessageBox.question(self, "Delete Chat", "Are you sure you want to delete this chat?",
                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
             if reply == QMessageBox.Yes:
-                delete_chat_session(session_id)
-                self.chat_list_widget.takeItem(self.chat_list_widget.row(item))
+                self.request_scheduler.cancel(session_id)
+                try:
+                    forget_rendered(content for _, role, content, _ in load_chat_history(session_id)
+                                    if role != "user")
+                    delete_chat_session(session_id)
+                except sqlite3.OperationalError as e:
+                    QMessageBox.critical(self, "Error", f"Could not delete the chat: {e}")
+                    return
+                self.chat_list_model.remove(session_id)
                 QMessageBox.information(self, "Deleted", "Chat has been deleted.")
                 if self.session_id == session_id:
                     self.new_chat()  # Clear the current chat if it was the one being viewed
 
 
-if __name__ == "__main__":
+def create_application(argv):
     initialize_database()
     load_dotenv()
-
-    app = QApplication([])
+    api_client.configure(url=os.getenv("OPENAI_BASE_URL"),
+                         request_timeout=float(os.getenv("OPENAI_TIMEOUT", api_client.DEFAULT_TIMEOUT)),
+                         request_connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT",
+                                                                 api_client.DEFAULT_CONNECT_TIMEOUT)),
+                         retries=int(os.getenv("OPENAI_MAX_RETRIES", api_client.DEFAULT_MAX_RETRIES)))
+    # GPT_DESKTOP_TIMINGS=1 records stage timings from the start; GPT_DESKTOP_TIMINGS_FILE
+    # also keeps them written to a file (.json, or Prometheus text otherwise)
+    timings_file = os.getenv("GPT_DESKTOP_TIMINGS_FILE")
+    instrumentation.enable(bool(os.getenv("GPT_DESKTOP_TIMINGS") or timings_file))
+
+    # Required when QtWebEngine is imported after the application is created
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication(argv)
     window = MainWindow()
+    window.timings_file = timings_file
     saved_font_name, saved_font_size = load_font_settings()
     window.prompt_entry.setFontFamily(saved_font_name)
     window.prompt_entry.setFontPointSize(saved_font_size)
     window.show()
+    app.aboutToQuit.connect(window.request_scheduler.shutdown)
+    app.aboutToQuit.connect(window.stop_background_tasks)
+    app.aboutToQuit.connect(save_tfidf_index)
+    app.aboutToQuit.connect(api_client.close_clients)
+    if timings_file:
+        app.aboutToQuit.connect(window.export_timings_file)
+    app.aboutToQuit.connect(storage.close_connections)
+    return app, window
+
+
+if __name__ == "__main__":
+    app, window = create_application(sys.argv)
     app.exec_()
@@ -0,0 +1,129 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+# Timings of named stages (a submit cycle, rendering, compression, ...), for the
+# diagnostics panel and for export as JSON or Prometheus text. Off by default: a
+# disabled span is a shared no-op context manager and a disabled @timed function costs
+# one flag check, so instrumented code can stay instrumented.
+#
+#   with instrumentation.span("worker.save"):
+#       ...
+#
+#   @instrumentation.timed()  # recorded as "<module>.<function>"
+#   def compress_text(...):
+#       ...
+MAX_SAMPLES = 1000  # most recent durations kept per stage for the percentiles
+METRIC_NAME = "gpt_desktop_stage_seconds"
+
+enabled = False
+_stages = {}  # name -> [recent durations, count, total seconds]
+_lock = threading.Lock()  # stages are recorded from worker threads too
+_NULL_SPAN = nullcontext()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def record(name, seconds):
+    if not enabled:
+        return
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = [deque(maxlen=MAX_SAMPLES), 0, 0.0]
+        stage[0].append(seconds)
+        stage[1] += 1
+        stage[2] += seconds
+
+
+class _Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def span(name):
+    return _Span(name) if enabled else _NULL_SPAN
+
+
+def timed(name=None):
+    def decorate(function):
+        stage = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def summary():
+    # {stage: {count, total_s, p50_ms, p95_ms, max_ms}}; percentiles over the recent samples
+    with _lock:
+        stages = {name: (sorted(samples), count, total) for name, (samples, count, total) in _stages.items()}
+    result = {}
+    for name, (values, count, total) in sorted(stages.items()):
+        result[name] = {"count": count,
+                        "total_s": round(total, 6),
+                        "p50_ms": round(values[len(values) // 2] * 1000, 3),
+                        "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+                        "max_ms": round(values[-1] * 1000, 3)}
+    return result
+
+
+def to_json():
+    return json.dumps({"timestamp": time.time(), "stages": summary()}, indent=2)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus():
+    # Text exposition format, e.g. for node_exporter's textfile collector
+    lines = [f"# HELP {METRIC_NAME} Time spent in each stage of the desktop client.",
+             f"# TYPE {METRIC_NAME} summary"]
+    for name, stage in summary().items():
+        label = f'stage="{_label(name)}"'
+        lines.append(f'{METRIC_NAME}{{{label},quantile="0.5"}} {round(stage["p50_ms"] / 1000, 6)}')
+        lines.append(f'{METRIC_NAME}{{{label},quantile="0.95"}} {round(stage["p95_ms"] / 1000, 6)}')
+        lines.append(f"{METRIC_NAME}_sum{{{label}}} {stage['total_s']}")
+        lines.append(f"{METRIC_NAME}_count{{{label}}} {stage['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def export(path):
+    # JSON for *.json, Prometheus text otherwise; replaced atomically so a collector
+    # never reads a half-written file
+    data = to_json() + "\n" if path.endswith(".json") else to_prometheus()
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as export_file:
+        export_file.write(data)
+    os.replace(temporary, path)
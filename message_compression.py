@@ -0,0 +1,174 @@
+# Compressed storage of chat message bodies: trains a shared dictionary on the stored
+# history, switches new messages to it and rewrites existing rows in the background.
+# Run as a script to migrate an existing database and compare its size and read
+# latency before and after:
+#
+#   python message_compression.py enable --db "%APPDATA%/GPTDesktopClient/settings.db"
+#   python message_compression.py report --db ...
+#   python message_compression.py disable --db ...   # back to plaintext
+#
+# While compression is on, or compressed rows are left after disabling it, the
+# chat_messages view and the triggers indexing chats for search call the message_text
+# SQL function. Other SQLite clients have to register storage.message_text to read
+# chat_messages or write to chats until `disable` has rewritten every row.
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+import storage
+from compression import build_compression_dictionary
+from dictionary_format import encode_dictionary
+from storage import get_connection, transaction
+
+DEFAULT_TOP_N = 1000
+DEFAULT_CODEC = "zlib"
+TRAINING_SAMPLE = 20000  # most recent messages the dictionary is trained on
+COMPACT_BATCH = 500  # rows rewritten per transaction
+# Rows not stored the way new messages are: another dictionary, or compressed with
+# another codec (plaintext rows only record the dictionary they were tried with)
+PENDING_CONDITION = "(dictionary_id IS NOT ? OR (content_blob IS NOT NULL AND content_codec IS NOT ?))"
+
+
+def train_dictionary(top_n=DEFAULT_TOP_N, sample=TRAINING_SAMPLE, mode="token_gain"):
+    # token_gain skips phrases a symbol wouldn't shorten; returns the stored dictionary's ID
+    texts = [row[0] for row in get_connection().execute(
+        "SELECT message_content FROM chat_messages ORDER BY id DESC LIMIT ?", (sample,)) if row[0]]
+    dictionary = build_compression_dictionary(texts, top_n=top_n, mode=mode)
+    return storage.save_compression_dictionary(encode_dictionary(dictionary))
+
+
+def enable(codec=DEFAULT_CODEC, top_n=DEFAULT_TOP_N, sample=TRAINING_SAMPLE):
+    dictionary_id = train_dictionary(top_n, sample)
+    storage.set_message_compression(dictionary_id, codec)
+    return dictionary_id
+
+
+def disable():
+    storage.set_message_compression(None)
+
+
+def pending_messages():
+    dictionary_id, codec = storage.message_compression or (None, None)
+    return get_connection().execute(f"SELECT COUNT(*) FROM chats WHERE {PENDING_CONDITION}",
+                                    (dictionary_id, codec)).fetchone()[0]
+
+
+def compact(batch_size=COMPACT_BATCH, vacuum=True, progress=None, should_stop=None):
+    # Rewrites every message stored differently from the current setting (plaintext after
+    # enabling, an older dictionary after retraining, compressed after disabling), one
+    # short transaction per batch so the app keeps working meanwhile. Rows that don't
+    # shrink stay plaintext, marked as tried with the current dictionary. Returns the
+    # number of rows rewritten; the database is vacuumed if the stored bytes changed.
+    compression = storage.message_compression
+    dictionary_id, codec = compression or (None, None)
+    total = pending_messages()
+    last_id = 0
+    rewritten = 0
+    resized = 0  # rows whose stored body changed size
+    while not (should_stop and should_stop()):
+        with transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, message_text(message_content, content_blob, dictionary_id, content_codec), "
+                "COALESCE(LENGTH(content_blob), LENGTH(CAST(message_content AS BLOB))) FROM chats "
+                f"WHERE id > ? AND {PENDING_CONDITION} ORDER BY id LIMIT ?",
+                (last_id, dictionary_id, codec, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for message_id, content, stored_size in rows:
+                columns = storage.encode_message(content, compression)
+                new_size = len(columns[1]) if columns[1] is not None else len(content.encode("utf-8"))
+                resized += new_size != stored_size
+                updates.append(columns + (message_id,))
+            conn.executemany(
+                "UPDATE chats SET message_content = ?, content_blob = ?, dictionary_id = ?, content_codec = ? "
+                "WHERE id = ?", updates)
+        last_id = rows[-1][0]
+        rewritten += len(rows)
+        if progress:
+            progress(rewritten, total)
+
+    with transaction() as conn:
+        conn.execute("DELETE FROM compression_dictionaries WHERE id IS NOT ? AND id NOT IN "
+                     "(SELECT DISTINCT dictionary_id FROM chats WHERE content_blob IS NOT NULL)", (dictionary_id,))
+        storage.update_message_schema()  # no longer needs message_text once nothing is compressed
+    if vacuum and resized:
+        vacuum_database()
+    return rewritten
+
+
+def vacuum_database():
+    # Gives the space freed by compaction back to the file system
+    conn = get_connection()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+
+
+def database_size():
+    return sum(os.path.getsize(path) for path in (storage.db_path, storage.db_path + "-wal")
+               if os.path.exists(path))
+
+
+def read_latency(sessions=50, repeat=3, seed=0):
+    # Median and worst load_chat_history time in ms over a fixed sample of sessions
+    session_ids = [row[0] for row in get_connection().execute("SELECT session_id FROM chat_sessions ORDER BY rowid")]
+    sample = random.Random(seed).sample(session_ids, min(sessions, len(session_ids)))
+    timings = []
+    for _ in range(repeat):
+        for session_id in sample:
+            started = time.perf_counter()
+            storage.load_chat_history(session_id)
+            timings.append((time.perf_counter() - started) * 1000)
+    if not timings:
+        return None
+    return {"median_ms": round(statistics.median(timings), 3), "max_ms": round(max(timings), 3)}
+
+
+def report():
+    conn = get_connection()
+    messages, compressed, plaintext_bytes, stored_bytes = conn.execute(
+        "SELECT COUNT(*), COUNT(content_blob), "
+        "COALESCE(SUM(LENGTH(CAST(message_text(message_content, content_blob, dictionary_id, content_codec) "
+        "AS BLOB))), 0), "
+        "COALESCE(SUM(COALESCE(LENGTH(content_blob), LENGTH(CAST(message_content AS BLOB)))), 0) FROM chats"
+    ).fetchone()
+    return {"database_bytes": database_size(),
+            "messages": messages,
+            "compressed_messages": compressed,
+            "plaintext_bytes": plaintext_bytes,
+            "stored_bytes": stored_bytes,
+            "compression": storage.message_compression,
+            "read_latency": read_latency()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed storage of chat message bodies")
+    parser.add_argument("command", choices=["enable", "disable", "compact", "report"])
+    parser.add_argument("--db", default=os.path.join(os.getenv("APPDATA", ""), "GPTDesktopClient", "settings.db"))
+    parser.add_argument("--codec", choices=["zlib", "zstd"], default=DEFAULT_CODEC)
+    parser.add_argument("--top-n", type=int, default=DEFAULT_TOP_N, help="dictionary entries")
+    parser.add_argument("--sample", type=int, default=TRAINING_SAMPLE, help="messages to train on")
+    args = parser.parse_args()
+
+    storage.configure(args.db)
+    storage.initialize_database()
+    before = report()
+    if args.command == "enable":
+        enable(args.codec, args.top_n, args.sample)
+    elif args.command == "disable":
+        disable()
+    if args.command != "report":
+        compact(progress=lambda done, total: print(f"\r{done}/{total} messages rewritten", end="", flush=True))
+        print()
+    results = {"before": before}
+    if args.command != "report":
+        results["after"] = report()
+    print(json.dumps(results, indent=2))
+    storage.close_connections()
+
+
+if __name__ == "__main__":
+    main()
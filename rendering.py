@@ -0,0 +1,424 @@
+import hashlib
+import html
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import storage
+from instrumentation import timed
+
+STYLE = "monokai"
+BACKGROUND_COLOR = "#2E2E2E"
+TEXT_COLOR = "#d8dee9"
+
+# Bump whenever render_markdown produces different HTML for the same input, so cached
+# renders from older versions are no longer used.
+RENDERER_VERSION = 2
+MEMORY_CACHE_SIZE = 512
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # render_cache table; least recently used renders go first
+CACHE_MAX_AGE = 90 * 24 * 3600  # seconds a stored render is kept without being used
+LANGUAGE_PREFIX = "language-"  # CodeHilite's lang_prefix
+
+current_style = STYLE
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()  # renders also happen on request worker threads
+_converters = threading.local()  # Markdown instances aren't thread safe; one per thread
+
+
+@lru_cache(maxsize=None)
+def code_block_formatter():
+    # Pygments HTML formatter that CodeHilite calls for every code block. It writes the
+    # header (language label and copy button) around the highlighted block while the
+    # markdown is converted, labelled with the language the block was highlighted as.
+    # Defined on first use so Pygments is not imported at startup.
+    from pygments.formatters.html import HtmlFormatter
+
+    class CodeBlockFormatter(HtmlFormatter):
+        def __init__(self, lang_str="", **options):
+            super().__init__(**options)
+            language = lang_str[len(LANGUAGE_PREFIX):] if lang_str.startswith(LANGUAGE_PREFIX) else lang_str
+            self.language = "plaintext" if language in ("", "text") else language
+
+        def format_unencoded(self, tokensource, outfile):
+            # copyToClipboard reads the element right after the header
+            outfile.write('<div class="code-block-container"><div class="code-header">'
+                          f'<span class="language">{html.escape(self.language)}</span>'
+                          '<button class="copy-button" onclick="copyToClipboard(this)">Copy</button></div>')
+            super().format_unencoded(tokensource, outfile)
+            outfile.write('</div>')
+
+    return CodeBlockFormatter
+
+
+def markdown_converter():
+    # Building a Markdown instance and its extensions costs more than converting a typical
+    # message, so each thread keeps one and resets it between messages
+    converter = getattr(_converters, "converter", None)
+    if converter is None:
+        from markdown import Markdown
+        from markdown.extensions.codehilite import CodeHiliteExtension
+        from markdown.extensions.fenced_code import FencedCodeExtension
+        # Untagged blocks are shown as plaintext rather than guessed, which tries every lexer
+        codehilite = CodeHiliteExtension(linenums=False, css_class='codehilite', guess_lang=False,
+                                         lang_prefix=LANGUAGE_PREFIX, pygments_formatter=code_block_formatter())
+        converter = _converters.converter = Markdown(extensions=[codehilite, FencedCodeExtension()])
+    return converter
+
+
+@timed()
+def render_markdown(content):
+    # Works on a fragment; the stylesheet and copyToClipboard live in the chat document
+    converter = markdown_converter()
+    try:
+        return converter.convert(content)
+    finally:
+        converter.reset()
+
+
+def render_cache_key(content, style=None):
+    data = f"{RENDERER_VERSION}\0{style or current_style}\0{content}".encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def render_markdown_many(contents):
+    # Same as [render_markdown(c) for c in contents], served from an in-memory LRU tier
+    # and then from the render_cache table when storage is configured. Messages never
+    # change once stored, so reopening a chat mostly just reads the cached HTML.
+    keys = [render_cache_key(content) for content in contents]
+    rendered = {}
+    missing = []
+    with _memory_cache_lock:
+        for key in keys:
+            if key in _memory_cache:
+                _memory_cache.move_to_end(key)
+                rendered[key] = _memory_cache[key]
+            else:
+                missing.append(key)
+    if missing and storage.db_path is not None:
+        rendered.update(storage.load_rendered_html(missing))
+
+    new_entries = []
+    for key, content in zip(keys, contents):
+        if key not in rendered:
+            rendered[key] = render_markdown(content)
+            new_entries.append((key, rendered[key]))
+    if new_entries and storage.db_path is not None:
+        try:
+            storage.save_rendered_html(new_entries, current_style, RENDERER_VERSION, CACHE_MAX_AGE, CACHE_MAX_BYTES)
+        except sqlite3.OperationalError:
+            pass  # the cache is best effort: with the database busy they are just rendered again
+
+    with _memory_cache_lock:
+        for key in missing:
+            _memory_cache[key] = rendered[key]
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+    return [rendered[key] for key in keys]
+
+
+def render_markdown_cached(content):
+    return render_markdown_many([content])[0]
+
+
+def set_style(style):
+    # Cached renders belong to the previous style; drop them
+    global current_style
+    current_style = style
+    with _memory_cache_lock:
+        _memory_cache.clear()
+    if storage.db_path is not None:
+        prune_render_cache()
+
+
+def prune_render_cache():
+    # Stored renders of other styles and renderer versions can never be used again
+    storage.clear_render_cache(keep_style=current_style, keep_version=RENDERER_VERSION)
+
+
+def forget_rendered(contents):
+    # Drops the cached renders of these messages, e.g. when their chat is deleted
+    keys = [render_cache_key(content) for content in contents]
+    with _memory_cache_lock:
+        for key in keys:
+            _memory_cache.pop(key, None)
+    if storage.db_path is not None:
+        storage.delete_rendered_html(keys)
+
+
+# Renders a message that is still arriving. Text is split into blocks at blank lines
+# outside fenced code; finished blocks are rendered once, and only the unfinished
+# trailing block is re-rendered on every update.
+class IncrementalMarkdownRenderer:
+    def __init__(self):
+        self.text = ""
+        self.rendered_to = 0  # end of the text already rendered as finished blocks
+        self.block_end = 0  # end of the last finished block
+        self.scanned_to = 0
+        self.in_fence = False
+
+    def feed(self, delta):
+        self.text += delta
+        complete_to = self.text.rfind("\n") + 1
+        for line in self.text[self.scanned_to:complete_to].splitlines(keepends=True):
+            self.scanned_to += len(line)
+            stripped = line.strip()
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                self.in_fence = not self.in_fence
+                if not self.in_fence:
+                    self.block_end = self.scanned_to
+            elif not stripped and not self.in_fence:
+                self.block_end = self.scanned_to
+
+    def render(self):
+        # Returns (html of newly finished blocks, html of the unfinished tail)
+        finished_html = ""
+        if self.block_end > self.rendered_to:
+            finished_html = render_markdown(self.text[self.rendered_to:self.block_end])
+            self.rendered_to = self.block_end
+        return finished_html, render_markdown(self.text[self.rendered_to:])
+
+
+def render_prompt(content):
+    return "Prompt: " + html.escape(content)
+
+
+@lru_cache(maxsize=None)
+def code_style_defs(style):
+    from pygments.formatters.html import HtmlFormatter
+    return HtmlFormatter(style=style).get_style_defs('.codehilite')
+
+
+def stylesheet(style=None):
+    style = style or current_style
+    return f"""
+        {code_style_defs(style)}
+        body {{
+            font-family: Arial, sans-serif;
+            margin: 8px;
+        }}
+        .message {{
+            margin-bottom: 12px;
+        }}
+        .message.user .prompt {{
+            white-space: pre-wrap;
+            padding: 8px;
+            border: 1px solid #c0c0c0;
+            border-radius: 6px;
+        }}
+        .message.assistant button.copy-response {{
+            margin-bottom: 6px;
+        }}
+        .message.assistant .cached-badge {{
+            margin-left: 8px;
+            padding: 1px 6px;
+            border-radius: 4px;
+            background: #fff3c4;
+            color: #6b5300;
+            font-size: 12px;
+        }}
+        .code-block-container {{
+            position: relative;
+            margin-bottom: 20px;
+            border: 1px solid #e1e4e8;
+            border-radius: 6px;
+            overflow: hidden;
+        }}
+        .code-header {{
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            background: {BACKGROUND_COLOR};
+            padding: 8px;
+            font-size: 12px;
+            font-family: Arial, sans-serif;
+            color: {TEXT_COLOR};
+            border-bottom: 1px solid #e1e4e8;
+        }}
+        .code-header .language {{
+            font-weight: bold;
+        }}
+        .code-header button.copy-button {{
+            background: none;
+            border: none;
+            color: #0366d6;
+            cursor: pointer;
+            font-size: 12px;
+        }}
+        pre {{
+            background: {BACKGROUND_COLOR};
+            color: {TEXT_COLOR};
+            border-radius: 0 0 6px 6px;
+            padding: 10px;
+            overflow-x: auto;
+            overflow-y: visible;
+            white-space: pre;
+            margin: 0;
+        }}
+    """
+
+
+# Script of the chat document. Messages are added and removed through these
+# functions (called with runJavaScript) and scrolling is reported back through the
+# QWebChannel bridge object.
+CHAT_SCRIPT = """
+    var bridge = null;
+    new QWebChannel(qt.webChannelTransport, function(channel) {
+        bridge = channel.objects.bridge;
+        checkFilled();
+    });
+
+    function copyToClipboard(button) {
+        var codeBlock = button.parentNode.nextSibling;
+        var text = codeBlock.innerText || codeBlock.textContent;
+        var tempTextArea = document.createElement("textarea");
+        tempTextArea.value = text;
+        document.body.appendChild(tempTextArea);
+        tempTextArea.select();
+        document.execCommand("copy");
+        document.body.removeChild(tempTextArea);
+        button.innerText = "Copied";
+        setTimeout(function() {
+            button.innerText = "Copy";
+        }, 10000);
+    }
+
+    function createMessage(message) {
+        var element = document.createElement("div");
+        element.id = "message-" + message.id;
+        element.className = "message " + message.role;
+        if (message.role === "user") {
+            element.innerHTML = '<div class="prompt">' + message.html + '</div>';
+        } else {
+            var badge = message.cached ? '<span class="cached-badge" title="Answered from the local response cache">' +
+                'Cached</span>' : '';
+            // A streaming response has no message ID yet; finishStream adds the button
+            var copy = typeof message.id === "number" ? '<button class="copy-response" ' +
+                'onclick="bridge.copyMessage(' + message.id + ')">Copy Response</button>' : '';
+            element.innerHTML = copy + badge + '<div class="content">' + message.html + '</div>';
+        }
+        return element;
+    }
+
+    function container() {
+        return document.getElementById("messages");
+    }
+
+    function appendMessages(messages, scrollToEnd) {
+        messages.forEach(function(message) {
+            container().appendChild(createMessage(message));
+        });
+        if (scrollToEnd) {
+            window.scrollTo(0, document.body.scrollHeight);
+        }
+        checkFilled();
+    }
+
+    function prependMessages(messages) {
+        // Keep the message the user is looking at in place
+        var before = document.body.scrollHeight;
+        var first = container().firstChild;
+        messages.forEach(function(message) {
+            container().insertBefore(createMessage(message), first);
+        });
+        window.scrollBy(0, document.body.scrollHeight - before);
+        checkFilled();
+    }
+
+    function removeMessages(count, fromTop) {
+        // The messages of a streaming exchange aren't counted as loaded and are kept
+        var element = fromTop ? container().firstChild : container().lastChild;
+        while (count > 0 && element) {
+            var next = fromTop ? element.nextSibling : element.previousSibling;
+            if (element.id.indexOf("message-pending-") !== 0) {
+                var height = element.offsetHeight;
+                container().removeChild(element);
+                if (fromTop) {
+                    window.scrollBy(0, -height);
+                }
+                count--;
+            }
+            element = next;
+        }
+    }
+
+    function startStream(promptHtml) {
+        appendMessages([{id: "pending-prompt", role: "user", html: promptHtml},
+                        {id: "pending-response", role: "assistant",
+                         html: '<div class="stream-finished"></div><div class="stream-tail"></div>'}], true);
+    }
+
+    function updateStream(finishedHtml, tailHtml) {
+        var response = document.getElementById("message-pending-response");
+        var atEnd = window.innerHeight + window.scrollY >= document.body.scrollHeight - 2;
+        if (finishedHtml) {
+            response.querySelector(".stream-finished").insertAdjacentHTML("beforeend", finishedHtml);
+        }
+        response.querySelector(".stream-tail").innerHTML = tailHtml;
+        if (atEnd) {
+            window.scrollTo(0, document.body.scrollHeight);
+        }
+    }
+
+    function finishStream(promptId, responseId, html, cached) {
+        // Swap the streamed blocks for the full render of the complete message
+        document.getElementById("message-pending-prompt").id = "message-" + promptId;
+        var response = document.getElementById("message-pending-response");
+        container().replaceChild(createMessage({id: responseId, role: "assistant", html: html, cached: cached}),
+                                 response);
+    }
+
+    function cancelStream() {
+        ["message-pending-prompt", "message-pending-response"].forEach(function(id) {
+            var element = document.getElementById(id);
+            if (element) {
+                element.remove();
+            }
+        });
+    }
+
+    function clearMessages() {
+        container().innerHTML = "";
+    }
+
+    function scrollToMessage(id) {
+        var element = document.getElementById("message-" + id);
+        if (element) {
+            element.scrollIntoView();
+        }
+    }
+
+    function checkFilled() {
+        // Ask for more history while the page is too short to scroll
+        if (bridge && document.body.scrollHeight <= window.innerHeight) {
+            bridge.scrolledToTop();
+        }
+    }
+
+    window.addEventListener("scroll", function() {
+        if (!bridge) {
+            return;
+        }
+        if (window.scrollY <= 0) {
+            bridge.scrolledToTop();
+        } else if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 2) {
+            bridge.scrolledToBottom();
+        }
+    });
+"""
+
+
+def chat_document(style=None):
+    style = style or current_style
+    return f"""
+    <html>
+    <head>
+        <style>{stylesheet(style)}</style>
+        <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
+    </head>
+    <body>
+        <div id="messages"></div>
+        <script>{CHAT_SCRIPT}</script>
+    </body>
+    </html>
+    """
@@ -0,0 +1,201 @@
+import itertools
+import threading
+import time
+from collections import deque
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+import response_cache
+from instrumentation import record, span
+from rendering import IncrementalMarkdownRenderer, render_markdown_cached
+from storage import ensure_chat_session, save_chat_messages, transaction
+from tokenizer import count_message_tokens
+
+STREAM_RENDER_INTERVAL = 0.05  # seconds between re-renders of a response while it streams in
+
+
+class CompletionRequest:
+    _ids = itertools.count(1)
+
+    def __init__(self, session_id, chat_name, model, user_prompt, api_key, use_cache=False):
+        self.request_id = next(self._ids)
+        self.session_id = session_id
+        self.chat_name = chat_name
+        self.model = model
+        self.user_prompt = user_prompt
+        self.api_key = api_key
+        self.use_cache = use_cache
+        self.messages = None  # filled in by the scheduler right before the request starts
+        self.context_report = None
+        self.cancel_event = threading.Event()
+        self.stream = None
+        self.submitted_at = time.perf_counter()
+
+    def cancel(self):
+        self.cancel_event.set()
+        # Closing the response also unblocks a worker waiting for the next chunk
+        stream = self.stream
+        if stream is not None and hasattr(stream, "close"):
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+
+class WorkerSignals(QObject):
+    progress = pyqtSignal(str, str)
+    finished = pyqtSignal(dict)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+# Runs one completion on a pool thread: streams the response, renders it and saves the
+# exchange. Results reach the GUI thread through queued signals.
+class CompletionWorker(QRunnable):
+    def __init__(self, request, send_request):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.request = request
+        self.send_request = send_request
+        self.signals = WorkerSignals()
+
+    def stream_response(self):
+        request = self.request
+        renderer = IncrementalMarkdownRenderer()
+        last_render = 0
+        request.stream = self.send_request(request.api_key, request.model, request.messages, request.cancel_event)
+        for chunk in request.stream:
+            if request.cancel_event.is_set():
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                renderer.feed(chunk.choices[0].delta.content)
+                now = time.monotonic()
+                if now - last_render >= STREAM_RENDER_INTERVAL:
+                    self.signals.progress.emit(*renderer.render())
+                    last_render = now
+        return renderer.text
+
+    def run(self):
+        request = self.request
+        try:
+            # An identical request (same model and messages) is answered from the cache
+            with span("worker.cache_lookup"):
+                response = response_cache.lookup(request.model, request.messages) if request.use_cache else None
+            cached = response is not None
+            if not cached:
+                with span("worker.stream"):
+                    response = self.stream_response()
+            if request.cancel_event.is_set():
+                self.signals.cancelled.emit()
+                return
+            if request.use_cache and not cached and response:
+                response_cache.store(request.model, request.messages, response)
+
+            with span("worker.render"):
+                html_content = render_markdown_cached(response)
+            with span("worker.count_tokens"):
+                token_counts = [count_message_tokens(request.user_prompt), count_message_tokens(response)]
+            with span("worker.save"), transaction():
+                ensure_chat_session(request.session_id, request.chat_name)
+                message_ids = save_chat_messages(request.session_id,
+                                                 [("user", request.user_prompt), ("assistant", response)],
+                                                 request.model, token_counts)
+            self.signals.finished.emit({"response": response, "html": html_content, "message_ids": message_ids,
+                                        "token_counts": token_counts, "cached": cached})
+        except Exception as e:
+            if request.cancel_event.is_set():
+                self.signals.cancelled.emit()
+            else:
+                self.signals.failed.emit(str(e))
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(int, int)  # done, total
+
+
+# Runs function(*args) on a pool thread, e.g. database maintenance. With
+# report_progress the function is also passed progress=callback(done, total), which
+# emits signals.progress.
+class BackgroundTask(QRunnable):
+    def __init__(self, function, *args, report_progress=False):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.function = function
+        self.args = args
+        self.report_progress = report_progress
+        self.signals = TaskSignals()
+
+    def run(self):
+        kwargs = {"progress": self.signals.progress.emit} if self.report_progress else {}
+        try:
+            result = self.function(*self.args, **kwargs)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+
+# Runs completions in the background. Requests of one chat session run one at a time,
+# in submission order, so each one is sent with the history including the previous
+# exchange; requests of different sessions run concurrently.
+class RequestScheduler(QObject):
+    started = pyqtSignal(object)
+    progress = pyqtSignal(object, str, str)
+    finished = pyqtSignal(object, dict)
+    failed = pyqtSignal(object, str)
+    cancelled = pyqtSignal(object)
+
+    def __init__(self, send_request, prepare_request, max_threads=4, parent=None):
+        super().__init__(parent)
+        self.send_request = send_request  # (api_key, model, messages, cancel_event) -> stream of chunks
+        self.prepare_request = prepare_request  # called on the GUI thread to set request.messages
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.queues = {}  # session_id -> requests waiting for the running one
+        self.active = {}  # session_id -> (request, worker)
+
+    def submit(self, request):
+        self.queues.setdefault(request.session_id, deque()).append(request)
+        self._start_next(request.session_id)
+
+    def in_flight(self, session_id):
+        return session_id in self.active or bool(self.queues.get(session_id))
+
+    def cancel(self, session_id=None):
+        sessions = list(set(self.queues) | set(self.active)) if session_id is None else [session_id]
+        for session in sessions:
+            for request in self.queues.pop(session, ()):
+                self.cancelled.emit(request)
+            if session in self.active:
+                self.active[session][0].cancel()
+
+    def shutdown(self, timeout_ms=2000):
+        self.cancel()
+        self.pool.waitForDone(timeout_ms)
+
+    def _start_next(self, session_id):
+        queue = self.queues.get(session_id)
+        if session_id in self.active or not queue:
+            return
+        request = queue.popleft()
+        if not queue:
+            del self.queues[session_id]
+
+        record("submit.queue_wait", time.perf_counter() - request.submitted_at)
+        with span("submit.prepare"):
+            self.prepare_request(request)
+        worker = CompletionWorker(request, self.send_request)
+        worker.signals.progress.connect(lambda finished, tail: self.progress.emit(request, finished, tail))
+        worker.signals.finished.connect(lambda result: self._done(request, self.finished, result))
+        worker.signals.failed.connect(lambda error: self._done(request, self.failed, error))
+        worker.signals.cancelled.connect(lambda: self._done(request, self.cancelled))
+        self.active[session_id] = (request, worker)
+        self.started.emit(request)
+        self.pool.start(worker)
+
+    def _done(self, request, signal, *args):
+        self.active.pop(request.session_id, None)
+        signal.emit(request, *args)
+        self._start_next(request.session_id)
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import threading
+
+from storage import clear_response_cache, load_cached_response, save_cached_response
+
+DEFAULT_TTL = 7 * 24 * 3600  # seconds
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+enabled = False  # opt-in; set from the Settings tab
+ttl = DEFAULT_TTL
+max_bytes = DEFAULT_MAX_BYTES
+
+stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+_stats_lock = threading.Lock()  # lookups happen on request worker threads
+
+
+def normalize_messages(messages):
+    # Line endings and surrounding whitespace don't change what is asked
+    return [{"role": message["role"], "content": message["content"].replace("\r\n", "\n").strip()}
+            for message in messages]
+
+
+def cache_key(model, messages, params=None):
+    data = json.dumps({"model": model, "messages": normalize_messages(messages), "params": params or {}},
+                      sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def lookup(model, messages, params=None):
+    response = load_cached_response(cache_key(model, messages, params), ttl)
+    with _stats_lock:
+        if response is None:
+            stats["misses"] += 1
+        else:
+            stats["hits"] += 1
+            stats["bytes_saved"] += len(response.encode("utf-8"))
+    return response
+
+
+def store(model, messages, response, params=None):
+    save_cached_response(cache_key(model, messages, params), model, response, ttl, max_bytes)
+
+
+def clear():
+    clear_response_cache()
+    with _stats_lock:
+        stats.update(hits=0, misses=0, bytes_saved=0)
@@ -0,0 +1,793 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+db_path = None
+tfidf_index_path = None
+
+# One long-lived connection per thread. Statements are compiled once per connection
+# and reused from sqlite3's statement cache.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+# (dictionary ID, codec) that new message bodies are compressed with; None stores them as
+# plaintext. Set from the settings table by initialize_database.
+message_compression = None
+_message_engines = {}  # dictionary ID -> CompressionEngine
+
+
+def configure(path):
+    global db_path, tfidf_index_path
+    close_connections()
+    db_path = path
+    tfidf_index_path = os.path.join(os.path.dirname(path), "tfidf_index.npz")
+
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        # Autocommit mode: transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function("message_text", 4, message_text, deterministic=True)
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections():
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        while _connections:
+            _connections.pop().close()
+
+
+@contextmanager
+def transaction():
+    # Nested transaction() blocks join the outermost one, so a whole exchange can be
+    # committed (and fsynced) once.
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    callbacks = _local.after_commit = []
+    try:
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        _local.after_commit = None
+    for callback in callbacks:
+        callback()
+
+
+def after_commit(callback):
+    # Runs callback once the outermost transaction() commits (right away outside one);
+    # it is dropped if the transaction rolls back
+    callbacks = getattr(_local, "after_commit", None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+# Schema migrations, applied in order by initialize_database. PRAGMA user_version
+# records how many have run: append new migrations, never edit released ones.
+MIGRATIONS = [
+    # 1: original schema
+    (
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY,
+            theme TEXT,
+            font_name TEXT,
+            font_size INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id INTEGER PRIMARY KEY,
+            api_key TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id TEXT PRIMARY KEY,
+            chat_name TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            message_role TEXT,
+            message_content TEXT,
+            model TEXT,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (session_id)
+        )
+        """,
+    ),
+    # 2: (session_id, id) index, timestamps and per-session message/token counters
+    (
+        "CREATE INDEX IF NOT EXISTS chats_session_id ON chats (session_id, id)",
+        "ALTER TABLE chats ADD COLUMN created_at REAL",
+        "ALTER TABLE chats ADD COLUMN token_count INTEGER",
+        "ALTER TABLE chat_sessions ADD COLUMN created_at REAL",
+        "ALTER TABLE chat_sessions ADD COLUMN updated_at REAL",
+        "ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE chat_sessions ADD COLUMN token_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE chats SET created_at = CAST(strftime('%s', 'now') AS REAL)",
+        """
+        UPDATE chat_sessions SET
+            created_at = CAST(strftime('%s', 'now') AS REAL),
+            updated_at = CAST(strftime('%s', 'now') AS REAL),
+            message_count = (SELECT COUNT(*) FROM chats WHERE chats.session_id = chat_sessions.session_id)
+        """,
+        "CREATE INDEX IF NOT EXISTS chat_sessions_updated_at ON chat_sessions (updated_at)",
+        """
+        CREATE TRIGGER chats_after_insert AFTER INSERT ON chats BEGIN
+            UPDATE chat_sessions SET
+                message_count = message_count + 1,
+                token_count = token_count + COALESCE(NEW.token_count, 0),
+                updated_at = COALESCE(NEW.created_at, updated_at)
+            WHERE session_id = NEW.session_id;
+        END
+        """,
+        """
+        CREATE TRIGGER chats_after_delete AFTER DELETE ON chats BEGIN
+            UPDATE chat_sessions SET
+                message_count = message_count - 1,
+                token_count = token_count - COALESCE(OLD.token_count, 0)
+            WHERE session_id = OLD.session_id;
+        END
+        """,
+        """
+        CREATE TRIGGER chats_after_update_token_count AFTER UPDATE OF token_count ON chats BEGIN
+            UPDATE chat_sessions SET
+                token_count = token_count - COALESCE(OLD.token_count, 0) + COALESCE(NEW.token_count, 0)
+            WHERE session_id = NEW.session_id;
+        END
+        """,
+    ),
+    # 3: full-text index over message bodies, kept in sync by triggers
+    (
+        "CREATE VIRTUAL TABLE chats_fts USING fts5(message_content, content='chats', content_rowid='id')",
+        """
+        CREATE TRIGGER chats_fts_after_insert AFTER INSERT ON chats BEGIN
+            INSERT INTO chats_fts (rowid, message_content) VALUES (NEW.id, NEW.message_content);
+        END
+        """,
+        """
+        CREATE TRIGGER chats_fts_after_delete AFTER DELETE ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message_content) VALUES ('delete', OLD.id, OLD.message_content);
+        END
+        """,
+        """
+        CREATE TRIGGER chats_fts_after_update AFTER UPDATE OF message_content ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message_content) VALUES ('delete', OLD.id, OLD.message_content);
+            INSERT INTO chats_fts (rowid, message_content) VALUES (NEW.id, NEW.message_content);
+        END
+        """,
+        "INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')",
+    ),
+    # 4: rendered message HTML, keyed by a hash of (renderer version, style, content)
+    (
+        """
+        CREATE TABLE render_cache (
+            key TEXT PRIMARY KEY,
+            style TEXT,
+            html TEXT,
+            created_at REAL
+        ) WITHOUT ROWID
+        """,
+    ),
+    # 5: per-model settings
+    (
+        """
+        CREATE TABLE model_settings (
+            model TEXT PRIMARY KEY,
+            context_budget INTEGER
+        )
+        """,
+    ),
+    # 6: response cache, evicted by age and least recent use
+    (
+        "ALTER TABLE settings ADD COLUMN response_cache_enabled INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            size INTEGER,
+            created_at REAL,
+            last_used REAL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX response_cache_last_used ON response_cache (last_used)",
+    ),
+    # 7: optionally compressed message bodies. Compressed rows keep message_content NULL
+    # and store the body in content_blob; chat_messages (and the FTS index built from
+    # it) always shows the plaintext through the message_text SQL function.
+    (
+        "ALTER TABLE chats ADD COLUMN content_blob BLOB",
+        "ALTER TABLE chats ADD COLUMN dictionary_id TEXT",
+        "ALTER TABLE chats ADD COLUMN content_codec TEXT",
+        "ALTER TABLE settings ADD COLUMN message_dictionary_id TEXT",
+        "ALTER TABLE settings ADD COLUMN message_codec TEXT",
+        """
+        CREATE TABLE compression_dictionaries (
+            id TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            created_at REAL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE VIEW chat_messages AS
+        SELECT id, session_id, message_role,
+               message_text(message_content, content_blob, dictionary_id, content_codec) AS message_content,
+               model, created_at, token_count
+        FROM chats
+        """,
+        "DROP TRIGGER chats_fts_after_insert",
+        "DROP TRIGGER chats_fts_after_delete",
+        "DROP TRIGGER chats_fts_after_update",
+        "DROP TABLE chats_fts",
+        "CREATE VIRTUAL TABLE chats_fts USING fts5(message_content, content='chat_messages', content_rowid='id')",
+        """
+        CREATE TRIGGER chats_fts_after_insert AFTER INSERT ON chats BEGIN
+            INSERT INTO chats_fts (rowid, message_content)
+            VALUES (NEW.id, message_text(NEW.message_content, NEW.content_blob, NEW.dictionary_id, NEW.content_codec));
+        END
+        """,
+        """
+        CREATE TRIGGER chats_fts_after_delete AFTER DELETE ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message_content)
+            VALUES ('delete', OLD.id,
+                    message_text(OLD.message_content, OLD.content_blob, OLD.dictionary_id, OLD.content_codec));
+        END
+        """,
+        # Recompressing a message rewrites its row but not its text; the index is only
+        # touched when the text changes
+        """
+        CREATE TRIGGER chats_fts_after_update
+        AFTER UPDATE OF message_content, content_blob, dictionary_id, content_codec ON chats
+        WHEN message_text(OLD.message_content, OLD.content_blob, OLD.dictionary_id, OLD.content_codec)
+             IS NOT message_text(NEW.message_content, NEW.content_blob, NEW.dictionary_id, NEW.content_codec)
+        BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message_content)
+            VALUES ('delete', OLD.id,
+                    message_text(OLD.message_content, OLD.content_blob, OLD.dictionary_id, OLD.content_codec));
+            INSERT INTO chats_fts (rowid, message_content)
+            VALUES (NEW.id, message_text(NEW.message_content, NEW.content_blob, NEW.dictionary_id, NEW.content_codec));
+        END
+        """,
+        "INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')",
+    ),
+    # 8: render cache entries record the renderer version and their size, and are evicted
+    # by age and least recent use. Older entries can't be told apart by version.
+    (
+        "DELETE FROM render_cache",
+        "ALTER TABLE render_cache ADD COLUMN renderer_version INTEGER",
+        "ALTER TABLE render_cache ADD COLUMN size INTEGER",
+        "ALTER TABLE render_cache ADD COLUMN last_used REAL",
+        "CREATE INDEX render_cache_last_used ON render_cache (last_used, size)",
+    ),
+]
+
+
+# chat_messages and the FTS triggers only need the message_text SQL function while
+# compressed rows can exist, and other SQLite clients (the sqlite3 shell, DB browsers,
+# plain sqlite3.connect scripts) don't have it. So they are recreated in this plain form
+# whenever compression is off and no compressed rows are left (update_message_schema),
+# and in the form migration 7 creates otherwise.
+PLAIN_MESSAGE_SCHEMA = (
+    "DROP VIEW chat_messages",
+    """
+    CREATE VIEW chat_messages AS
+    SELECT id, session_id, message_role, message_content, model, created_at, token_count
+    FROM chats
+    """,
+    "DROP TRIGGER chats_fts_after_insert",
+    "DROP TRIGGER chats_fts_after_delete",
+    "DROP TRIGGER chats_fts_after_update",
+    """
+    CREATE TRIGGER chats_fts_after_insert AFTER INSERT ON chats BEGIN
+        INSERT INTO chats_fts (rowid, message_content) VALUES (NEW.id, NEW.message_content);
+    END
+    """,
+    """
+    CREATE TRIGGER chats_fts_after_delete AFTER DELETE ON chats BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, message_content) VALUES ('delete', OLD.id, OLD.message_content);
+    END
+    """,
+    """
+    CREATE TRIGGER chats_fts_after_update AFTER UPDATE OF message_content ON chats
+    WHEN OLD.message_content IS NOT NEW.message_content
+    BEGIN
+        INSERT INTO chats_fts (chats_fts, rowid, message_content) VALUES ('delete', OLD.id, OLD.message_content);
+        INSERT INTO chats_fts (rowid, message_content) VALUES (NEW.id, NEW.message_content);
+    END
+    """,
+)
+COMPRESSED_MESSAGE_SCHEMA = (
+    "DROP VIEW chat_messages",
+    "DROP TRIGGER chats_fts_after_insert",
+    "DROP TRIGGER chats_fts_after_delete",
+    "DROP TRIGGER chats_fts_after_update",
+) + tuple(statement for statement in MIGRATIONS[6] if "CREATE VIEW" in statement or "CREATE TRIGGER" in statement)
+
+
+def update_message_schema():
+    # Switches chat_messages and the FTS triggers to the form the stored rows need
+    with transaction() as conn:
+        view = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'chat_messages'").fetchone()
+        compressed_schema = "message_text" in view[0]
+        if message_compression is not None:
+            needed = True
+        elif compressed_schema:
+            needed = conn.execute("SELECT 1 FROM chats WHERE content_blob IS NOT NULL LIMIT 1").fetchone() is not None
+        else:
+            needed = False
+        if needed != compressed_schema:
+            for statement in COMPRESSED_MESSAGE_SCHEMA if needed else PLAIN_MESSAGE_SCHEMA:
+                conn.execute(statement)
+
+
+def schema_version():
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+def initialize_database():
+    with transaction() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+    load_message_compression()
+    update_message_schema()
+
+
+def save_encrypted_api_key(encrypted_api_key):
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO api_keys (id, api_key) VALUES (1, ?)", (encrypted_api_key,))
+
+
+def load_encrypted_api_key():
+    result = get_connection().execute("SELECT api_key FROM api_keys WHERE id = 1").fetchone()
+    return result[0] if result else None
+
+
+def save_font_settings(font_name, font_size):
+    # Upsert, so the other settings in the row are kept
+    with transaction() as conn:
+        conn.execute("INSERT INTO settings (id, font_name, font_size) VALUES (1, ?, ?) "
+                     "ON CONFLICT (id) DO UPDATE SET font_name = excluded.font_name, font_size = excluded.font_size",
+                     (font_name, font_size))
+
+
+def load_font_settings():
+    result = get_connection().execute("SELECT font_name, font_size FROM settings WHERE id = 1").fetchone()
+    if result:
+        return result[0], result[1]
+    return "Arial", 12  # default font settings if none are saved
+
+
+def save_response_cache_enabled(enabled):
+    with transaction() as conn:
+        conn.execute("INSERT INTO settings (id, response_cache_enabled) VALUES (1, ?) "
+                     "ON CONFLICT (id) DO UPDATE SET response_cache_enabled = excluded.response_cache_enabled",
+                     (int(enabled),))
+
+
+def load_response_cache_enabled():
+    result = get_connection().execute("SELECT response_cache_enabled FROM settings WHERE id = 1").fetchone()
+    return bool(result and result[0])
+
+
+def load_message_compression():
+    global message_compression
+    row = get_connection().execute("SELECT message_dictionary_id, message_codec FROM settings WHERE id = 1").fetchone()
+    message_compression = (row[0], row[1]) if row and row[0] else None
+    return message_compression
+
+
+def set_message_compression(dictionary_id, codec="zlib"):
+    # Compress new message bodies with this dictionary (None: store plaintext). Existing
+    # rows are rewritten by message_compression.compact, which also switches back to the
+    # plain schema once none are compressed.
+    global message_compression
+    with transaction() as conn:
+        conn.execute("INSERT INTO settings (id, message_dictionary_id, message_codec) VALUES (1, ?, ?) "
+                     "ON CONFLICT (id) DO UPDATE SET message_dictionary_id = excluded.message_dictionary_id, "
+                     "message_codec = excluded.message_codec",
+                     (dictionary_id, codec if dictionary_id else None))
+        message_compression = (dictionary_id, codec) if dictionary_id else None
+        update_message_schema()
+
+
+def save_compression_dictionary(data):
+    # data: a dictionary encoded by dictionary_format.encode_dictionary; returns its ID
+    from dictionary_format import MappedDictionary
+    dictionary_id = MappedDictionary(data).dictionary_id
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO compression_dictionaries (id, data, created_at) VALUES (?, ?, ?)",
+                     (dictionary_id, data, time.time()))
+    return dictionary_id
+
+
+def message_engine(dictionary_id):
+    engine = _message_engines.get(dictionary_id)
+    if engine is None:
+        from compression import CompressionEngine
+        from dictionary_format import MappedDictionary
+        row = get_connection().execute("SELECT data FROM compression_dictionaries WHERE id = ?",
+                                       (dictionary_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Compression dictionary {dictionary_id} is not stored")
+        engine = _message_engines[dictionary_id] = CompressionEngine(MappedDictionary(row[0]))
+    return engine
+
+
+def message_text(content, blob, dictionary_id, codec):
+    # SQL function: the plaintext body of a chats row, whether it is compressed or not
+    if blob is None:
+        return content
+    return message_engine(dictionary_id).decompress_bytes(blob, "raw", codec).decode("utf-8")
+
+
+def encode_message(content, compression=None):
+    # (message_content, content_blob, dictionary_id, content_codec) column values for a
+    # message body. Bodies that compression doesn't shrink are kept as plaintext, with
+    # the dictionary they were tried with and no codec, so compaction leaves them alone
+    # until the dictionary changes. So are bodies that don't decompress back to themselves,
+    # e.g. text that already contains a symbol such as __W3__.
+    if compression is None:
+        return content, None, None, None
+    dictionary_id, codec = compression
+    data = content.encode("utf-8")
+    engine = message_engine(dictionary_id)
+    blob = engine.compress_bytes(data, "raw", codec)
+    if len(blob) >= len(data) or engine.decompress_bytes(blob, "raw", codec) != data:
+        return content, None, dictionary_id, None
+    return None, blob, dictionary_id, codec
+
+
+def save_context_budget(model, budget):
+    with transaction() as conn:
+        conn.execute("INSERT INTO model_settings (model, context_budget) VALUES (?, ?) "
+                     "ON CONFLICT (model) DO UPDATE SET context_budget = excluded.context_budget", (model, budget))
+
+
+def load_context_budgets():
+    return dict(get_connection().execute(
+        "SELECT model, context_budget FROM model_settings WHERE context_budget IS NOT NULL"))
+
+
+def create_chat_session(session_id, chat_name):
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("INSERT INTO chat_sessions (session_id, chat_name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                     (session_id, chat_name, now, now))
+
+
+def ensure_chat_session(session_id, chat_name):
+    # Creates the session unless it already exists
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO chat_sessions (session_id, chat_name, created_at, updated_at) "
+                     "VALUES (?, ?, ?, ?)", (session_id, chat_name, now, now))
+
+
+def update_chat_name(session_id, new_name):
+    with transaction() as conn:
+        conn.execute("UPDATE chat_sessions SET chat_name = ? WHERE session_id = ?", (new_name, session_id))
+
+
+def delete_chat_session(session_id):
+    with transaction() as conn:
+        message_ids = [row[0] for row in conn.execute("SELECT id FROM chats WHERE session_id = ?", (session_id,))]
+        conn.execute("DELETE FROM chats WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+        after_commit(lambda: update_tfidf_index(removed=message_ids))
+
+
+def save_chat_history(session_id, role, content, model):
+    return save_chat_messages(session_id, [(role, content)], model)[0]
+
+
+def save_chat_messages(session_id, messages, model, token_counts=None):
+    # Writes a batch of (role, content) messages in one transaction and returns their ids
+    message_ids = []
+    now = time.time()
+    token_counts = token_counts or [None] * len(messages)
+    with transaction() as conn:
+        for (role, content), token_count in zip(messages, token_counts):
+            cursor = conn.execute(
+                "INSERT INTO chats (session_id, message_role, model, created_at, token_count, "
+                "message_content, content_blob, dictionary_id, content_codec) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, role, model, now, token_count) + encode_message(content, message_compression))
+            message_ids.append(cursor.lastrowid)
+        documents = list(zip(message_ids, (content for _, content in messages)))
+        after_commit(lambda: update_tfidf_index(added=documents))
+    return message_ids
+
+
+def load_chat_sessions():
+    # Most recently active first
+    return get_connection().execute(
+        "SELECT session_id, chat_name FROM chat_sessions ORDER BY updated_at DESC, rowid DESC").fetchall()
+
+
+def load_chat_sessions_page(after=None, limit=100):
+    # One page of load_chat_sessions as (session_id, chat_name, updated_at, rowid); pass the
+    # last two fields of the previous page's last row as `after` for the next page. Seeks
+    # the updated_at index instead of skipping rows, so every page costs the same.
+    if after is None:
+        return get_connection().execute(
+            "SELECT session_id, chat_name, updated_at, rowid FROM chat_sessions "
+            "ORDER BY updated_at DESC, rowid DESC LIMIT ?", (limit,)).fetchall()
+    return get_connection().execute(
+        "SELECT session_id, chat_name, updated_at, rowid FROM chat_sessions WHERE (updated_at, rowid) < (?, ?) "
+        "ORDER BY updated_at DESC, rowid DESC LIMIT ?", (*after, limit)).fetchall()
+
+
+def load_chat_sessions_by_id(session_ids):
+    # (session_id, chat_name) of the given sessions, most recently active first
+    session_ids = list(session_ids)
+    sessions = []
+    conn = get_connection()
+    for start in range(0, len(session_ids), 500):
+        batch = session_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(batch))
+        sessions.extend(conn.execute(
+            f"SELECT session_id, chat_name, updated_at, rowid FROM chat_sessions "
+            f"WHERE session_id IN ({placeholders})", batch))
+    sessions.sort(key=lambda row: (row[2] or 0, row[3]), reverse=True)
+    return [(session_id, chat_name) for session_id, chat_name, _, _ in sessions]
+
+
+def load_chat_history(session_id):
+    return get_connection().execute(
+        "SELECT id, message_role, message_content, model FROM chat_messages WHERE session_id = ? ORDER BY id",
+        (session_id,)).fetchall()
+
+
+def load_chat_context(session_id):
+    # Like load_chat_history, with the cached token count of each message (None if not counted yet)
+    return get_connection().execute(
+        "SELECT id, message_role, message_content, token_count FROM chat_messages WHERE session_id = ? ORDER BY id",
+        (session_id,)).fetchall()
+
+
+def save_token_counts(counts):
+    # counts: (message id, token count) pairs
+    with transaction() as conn:
+        conn.executemany("UPDATE chats SET token_count = ? WHERE id = ?",
+                         [(token_count, message_id) for message_id, token_count in counts])
+
+
+def load_chat_history_page(session_id, before_id=None, limit=40):
+    # Keyset pagination over the (session_id, id) index: the `limit` messages just
+    # before before_id (the latest ones when before_id is None), oldest first
+    if before_id is None:
+        rows = get_connection().execute(
+            "SELECT id, message_role, message_content, model FROM chat_messages WHERE session_id = ? "
+            "ORDER BY id DESC LIMIT ?", (session_id, limit)).fetchall()
+    else:
+        rows = get_connection().execute(
+            "SELECT id, message_role, message_content, model FROM chat_messages WHERE session_id = ? AND id < ? "
+            "ORDER BY id DESC LIMIT ?", (session_id, before_id, limit)).fetchall()
+    rows.reverse()
+    return rows
+
+
+def load_chat_history_after(session_id, after_id, limit=40):
+    return get_connection().execute(
+        "SELECT id, message_role, message_content, model FROM chat_messages WHERE session_id = ? AND id > ? "
+        "ORDER BY id LIMIT ?", (session_id, after_id, limit)).fetchall()
+
+
+def fts_query(text):
+    # Turns free text into an FTS5 query: every word must match, and the last one is a
+    # prefix so results update while the user is still typing it.
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms and not text[-1].isspace():
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_messages(text, limit=200, session_id=None):
+    # Best matches first, in one session if session_id is given: (message id, session id,
+    # role, snippet)
+    query = fts_query(text)
+    if not query:
+        return []
+    session_filter, params = ("", (query,)) if session_id is None else ("AND chats.session_id = ?", (query, session_id))
+    return get_connection().execute(f"""
+        SELECT chats.id, chats.session_id, chats.message_role,
+               snippet(chats_fts, 0, '[', ']', '...', 12)
+        FROM chats_fts JOIN chats ON chats.id = chats_fts.rowid
+        WHERE chats_fts MATCH ? {session_filter}
+        ORDER BY chats_fts.rank
+        LIMIT ?
+    """, params + (limit,)).fetchall()
+
+
+def search_sessions(text):
+    # IDs of every session with a matching message; unlike search_messages not capped,
+    # so no matching chat is left out however many messages match
+    query = fts_query(text)
+    if not query:
+        return []
+    return [row[0] for row in get_connection().execute(
+        "SELECT DISTINCT chats.session_id FROM chats_fts JOIN chats ON chats.id = chats_fts.rowid "
+        "WHERE chats_fts MATCH ?", (query,))]
+
+
+RENDER_CACHE_TOUCH_INTERVAL = 3600  # seconds; last_used is only rewritten this often
+
+
+def load_rendered_html(keys):
+    # Returns {key: html} for the keys found in the render cache and marks them used
+    found = {}
+    stale = []
+    now = time.time()
+    conn = get_connection()
+    keys = list(keys)
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        placeholders = ", ".join("?" * len(batch))
+        for key, html, last_used in conn.execute(
+                f"SELECT key, html, last_used FROM render_cache WHERE key IN ({placeholders})", batch):
+            found[key] = html
+            if last_used < now - RENDER_CACHE_TOUCH_INTERVAL:
+                stale.append((now, key))
+    if stale:
+        try:
+            with transaction() as conn:
+                conn.executemany("UPDATE render_cache SET last_used = ? WHERE key = ?", stale)
+        except sqlite3.OperationalError:
+            pass  # only orders eviction; the next load touches them
+    return found
+
+
+def save_rendered_html(entries, style, renderer_version, max_age, max_bytes):
+    # entries: (key, html) pairs. Then evicts entries unused for max_age seconds and, once
+    # the cache outgrows max_bytes, the least recently used ones down to 90% of it, so
+    # the (full scan) eviction doesn't run again on the next saves. The total is read
+    # from the (last_used, size) index.
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO render_cache (key, style, html, renderer_version, size, "
+                         "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         ((key, style, html, renderer_version, len(html.encode("utf-8")), now, now)
+                          for key, html in entries))
+        conn.execute("DELETE FROM render_cache WHERE last_used < ?", (now - max_age,))
+        if conn.execute("SELECT COALESCE(SUM(size), 0) FROM render_cache").fetchone()[0] > max_bytes:
+            conn.execute("""
+                DELETE FROM render_cache WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept FROM render_cache
+                    ) WHERE kept > ?
+                )
+                """, (max_bytes * 9 // 10,))
+
+
+def delete_rendered_html(keys):
+    keys = list(keys)
+    with transaction() as conn:
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ", ".join("?" * len(batch))
+            conn.execute(f"DELETE FROM render_cache WHERE key IN ({placeholders})", batch)
+
+
+def load_cached_response(key, max_age):
+    # The cached response for key, unless it is older than max_age seconds
+    now = time.time()
+    with transaction() as conn:
+        row = conn.execute("SELECT response FROM response_cache WHERE key = ? AND created_at >= ?",
+                           (key, now - max_age)).fetchone()
+        if row:
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+    return row[0] if row else None
+
+
+def save_cached_response(key, model, response, max_age, max_bytes):
+    # Stores a response, then evicts expired entries and the least recently used ones
+    # until the cache fits in max_bytes
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("INSERT OR REPLACE INTO response_cache (key, model, response, size, created_at, last_used) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (key, model, response, len(response.encode("utf-8")), now, now))
+        conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - max_age,))
+        conn.execute("""
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS kept FROM response_cache
+                ) WHERE kept > ?
+            )
+            """, (max_bytes,))
+
+
+def clear_response_cache():
+    with transaction() as conn:
+        conn.execute("DELETE FROM response_cache")
+
+
+def clear_render_cache(keep_style=None, keep_version=None):
+    # Without arguments removes everything; otherwise only what another style or
+    # renderer version produced
+    with transaction() as conn:
+        if keep_style is None and keep_version is None:
+            conn.execute("DELETE FROM render_cache")
+        else:
+            conn.execute("DELETE FROM render_cache WHERE style IS NOT ? OR renderer_version IS NOT ?",
+                         (keep_style, keep_version))
+
+
+# TF-IDF index over the chats table. Loaded on first use, then kept up to date by
+# save_chat_messages/delete_chat_session (once their changes are committed) and
+# written back by save_tfidf_index.
+tfidf_index = None
+_tfidf_lock = threading.Lock()  # updates come from request workers, imports and the GUI
+_tfidf_load_lock = threading.Lock()
+# Updates run after their commits, but not necessarily in commit order: a chat can be
+# deleted before the update adding its last message runs. Such messages are remembered
+# here and not added (ids are never reused).
+_tfidf_removed_early = set()
+
+
+def update_tfidf_index(added=(), removed=()):
+    # added: (message id, text) pairs, removed: message ids. Changes committed while the
+    # index is still loading are picked up by get_tfidf_index from the database instead.
+    with _tfidf_lock:
+        if tfidf_index is None:
+            return
+        removed = list(removed)
+        _tfidf_removed_early.update(doc_id for doc_id in removed if doc_id not in tfidf_index)
+        tfidf_index.remove(removed)
+        for doc_id, text in added:
+            if doc_id in _tfidf_removed_early:
+                _tfidf_removed_early.discard(doc_id)
+            else:
+                tfidf_index.add(doc_id, text)
+
+
+def _catch_up_tfidf_index(index):
+    conn = get_connection()
+    existing_ids = {row[0] for row in conn.execute("SELECT id FROM chats")}
+    index.remove([doc_id for doc_id in list(index.rows) if doc_id not in existing_ids])
+    index.add_many(conn.execute("SELECT id, message_content FROM chat_messages WHERE id > ? ORDER BY id",
+                                (index.max_doc_id,)))
+
+
+def get_tfidf_index():
+    global tfidf_index
+    with _tfidf_load_lock:
+        if tfidf_index is None:
+            from tfidf_index import TfidfIndex
+            index = TfidfIndex.load(tfidf_index_path) if os.path.exists(tfidf_index_path) else TfidfIndex()
+            _catch_up_tfidf_index(index)  # the slow part; messages can still be saved meanwhile
+            with _tfidf_lock:
+                _catch_up_tfidf_index(index)  # what was committed since
+                tfidf_index = index
+    return tfidf_index
+
+
+def save_tfidf_index():
+    if tfidf_index is not None:
+        tfidf_index.save(tfidf_index_path)
@@ -0,0 +1,164 @@
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Same analyzer as TfidfVectorizer's defaults (lowercase, tokens of 2+ word characters)
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+# TF-IDF index over chat messages that can be updated one message at a time.
+# Raw term counts are stored per message as CSR arrays and IDF weights are applied at
+# query time from the document frequencies, so adding or removing a message never
+# requires a refit. Weights match TfidfVectorizer(smooth_idf=True, norm='l2').
+# Safe to update and query from several threads.
+class TfidfIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.vocabulary = {}
+        self.terms = []
+        self.document_frequency = array('q')
+        self.doc_ids = array('q')
+        self.indptr = array('q', [0])
+        self.indices = array('i')
+        self.counts = array('f')
+        self.live = bytearray()
+        self.rows = {}
+        self.max_doc_id = 0
+        self._matrix = None
+        self._terms_array = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.rows
+
+    def add(self, doc_id, text):
+        with self.lock:
+            if doc_id in self.rows:
+                self.remove([doc_id])
+            vocabulary = self.vocabulary
+            for term, count in Counter(TOKEN_PATTERN.findall(text.lower())).items():
+                index = vocabulary.get(term)
+                if index is None:
+                    index = vocabulary[term] = len(self.terms)
+                    self.terms.append(term)
+                    self.document_frequency.append(0)
+                    self._terms_array = None
+                self.indices.append(index)
+                self.counts.append(count)
+                self.document_frequency[index] += 1
+            self.indptr.append(len(self.indices))
+            self.rows[doc_id] = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self.live.append(1)
+            self.max_doc_id = max(self.max_doc_id, doc_id)
+            self._matrix = None
+
+    def add_many(self, documents):
+        with self.lock:
+            for doc_id, text in documents:
+                self.add(doc_id, text)
+            return self
+
+    def remove(self, doc_ids):
+        with self.lock:
+            for doc_id in doc_ids:
+                row = self.rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                for index in self.indices[self.indptr[row]:self.indptr[row + 1]]:
+                    self.document_frequency[index] -= 1
+                self.live[row] = 0
+            self._matrix = None
+
+    def idf(self):
+        with self.lock:
+            df = np.frombuffer(self.document_frequency, dtype=np.int64)
+            return np.log((1 + len(self.rows)) / (1 + df)) + 1
+
+    def tfidf_matrix(self):
+        # Rows are in insertion order and include removed messages; use row_ids()
+        # to select live ones.
+        with self.lock:
+            if self._matrix is None:
+                # Copies, so the array buffers can keep growing after the matrix is built
+                indptr = np.frombuffer(self.indptr, dtype=np.int64).copy()
+                indices = np.frombuffer(self.indices, dtype=np.int32).copy()
+                data = np.frombuffer(self.counts, dtype=np.float32) * self.idf()[indices]
+                row_of_entry = np.repeat(np.arange(len(self.doc_ids)), np.diff(indptr))
+                norms = np.sqrt(np.bincount(row_of_entry, weights=data * data, minlength=len(self.doc_ids)))
+                norms[norms == 0] = 1
+                data /= norms[row_of_entry]
+                self._matrix = csr_matrix((data, indices, indptr), shape=(len(self.doc_ids), len(self.terms)))
+            return self._matrix
+
+    def row_ids(self, doc_ids=None):
+        with self.lock:
+            if doc_ids is None:
+                return np.flatnonzero(np.frombuffer(self.live, dtype=np.uint8))
+            return np.fromiter((self.rows[doc_id] for doc_id in doc_ids), dtype=np.int64)
+
+    def top_terms(self, doc_ids=None, k=10):
+        # Returns (doc_ids, terms, scores); terms and scores have shape (n_docs, k) and
+        # are padded with '' and 0 for messages with fewer than k distinct terms.
+        with self.lock:
+            rows = self.row_ids(doc_ids)
+            matrix = self.tfidf_matrix()[rows]
+            if self._terms_array is None:
+                self._terms_array = np.array(self.terms, dtype=str)
+            terms_array = self._terms_array
+            row_doc_ids = np.frombuffer(self.doc_ids, dtype=np.int64)[rows]
+        entries_per_row = np.diff(matrix.indptr)
+        row_of_entry = np.repeat(np.arange(len(rows)), entries_per_row)
+        order = np.lexsort((-matrix.data, row_of_entry))
+        rank = np.arange(len(order)) - matrix.indptr[row_of_entry[order]]
+        keep = order[rank < k]
+        out_rows = row_of_entry[keep]
+        out_cols = rank[rank < k]
+
+        terms = np.full((len(rows), k), '', dtype=terms_array.dtype)
+        scores = np.zeros((len(rows), k), dtype=np.float64)
+        terms[out_rows, out_cols] = terms_array[matrix.indices[keep]]
+        scores[out_rows, out_cols] = matrix.data[keep]
+        return row_doc_ids, terms, scores
+
+    def save(self, path):
+        with self.lock:
+            rows = self.row_ids()
+            counts = csr_matrix((np.frombuffer(self.counts, dtype=np.float32),
+                                 np.frombuffer(self.indices, dtype=np.int32),
+                                 np.frombuffer(self.indptr, dtype=np.int64)),
+                                shape=(len(self.doc_ids), len(self.terms)))[rows]
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as index_file:
+                np.savez(index_file,
+                         terms=np.array(self.terms, dtype=str),
+                         document_frequency=np.frombuffer(self.document_frequency, dtype=np.int64),
+                         doc_ids=np.frombuffer(self.doc_ids, dtype=np.int64)[rows],
+                         indptr=counts.indptr.astype(np.int64),
+                         indices=counts.indices.astype(np.int32),
+                         counts=counts.data.astype(np.float32),
+                         max_doc_id=np.int64(self.max_doc_id))
+            os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as saved:
+            index.terms = saved["terms"].tolist()
+            index.vocabulary = {term: i for i, term in enumerate(index.terms)}
+            index.document_frequency = array('q', saved["document_frequency"].tobytes())
+            index.doc_ids = array('q', saved["doc_ids"].tobytes())
+            index.indptr = array('q', saved["indptr"].tobytes())
+            index.indices = array('i', saved["indices"].tobytes())
+            index.counts = array('f', saved["counts"].tobytes())
+            index.max_doc_id = int(saved["max_doc_id"])
+        index.live = bytearray(b'\x01' * len(index.doc_ids))
+        index.rows = {doc_id: row for row, doc_id in enumerate(index.doc_ids)}
+        return index
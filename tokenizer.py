@@ -0,0 +1,38 @@
+import re
+from functools import lru_cache
+
+# Counts are made with one encoding whatever the model, so a count cached for a
+# message stays valid when the chat switches models. cl100k_base never undercounts
+# newer encodings such as o200k_base by much, which is the safe side for budgets.
+ENCODING_NAME = "cl100k_base"
+MESSAGE_OVERHEAD = 4  # tokens each chat message adds for its role and separators
+REPLY_OVERHEAD = 3  # tokens that prime the assistant's reply
+
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name=ENCODING_NAME):
+    # tiktoken is optional, and it downloads encodings on first use; without it (or
+    # offline) counts fall back to an estimate
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    # Words and punctuation marks, with long words counted as one token per 4 characters
+    return sum((len(token) + 3) // 4 for token in ESTIMATE_PATTERN.findall(text))
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(content):
+    return count_tokens(content) + MESSAGE_OVERHEAD